@@ -0,0 +1,313 @@
+# Command-line interface to the full pipeline, without the GUI (e.g. for compute nodes or cron jobs).
+# The subcommands mirror the GUI:
+#   points        sample points from river images
+#   replicates    draw the replicates of Points files
+#   test          apply the bimodality test to replicate directories (or, with --from-points, to Points files)
+#   significance  test the bimodality results of unknowns against a control set
+#   calibrate     find the optimal bandwidth of the bimodality test
+#   controls      build a control set from the Points files of control rivers
+#   startup       measure the cold-start time of the GUI, this interface and the pool workers
+# Inputs can be given as files, directories or glob patterns; run 'python cli.py <subcommand> -h' for the options.
+import argparse
+import glob
+import os
+import sys
+import traceback
+import matplotlib
+matplotlib.use("Agg")
+
+# Setup paths and imports
+if getattr(sys, 'frozen', False):
+    script_path = os.path.dirname(sys.executable)
+else:
+    script_path = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.append(os.path.join(script_path, 'utils'))
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".npy")
+POINTS_EXTENSIONS = (".npz", ".csv")
+
+def expand_inputs(inputs, extensions, label, recursive=False):
+    # Files matching the extensions from a list of files, directories and glob patterns, in order and without duplicates.
+    # Directories are searched recursively if recursive is set, otherwise only the files directly in them are used.
+    # Inputs that do not exist are reported and skipped; returns the files and the number of missing inputs.
+    paths = []
+    missing = 0
+    for item in inputs:
+        if not glob.has_magic(item) and not os.path.exists(item):
+            print(f"[{label}] input not found: {item}", file=sys.stderr)
+            missing += 1
+            continue
+        for match in (sorted(glob.glob(item, recursive=True)) if glob.has_magic(item) else [item]):
+            if os.path.isdir(match) and recursive:
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(extensions))
+            elif os.path.isdir(match):
+                paths.extend(os.path.join(match, f) for f in sorted(os.listdir(match)) if f.lower().endswith(extensions))
+            else:
+                paths.append(match)
+    return list(dict.fromkeys(paths)), missing
+
+def prefer_npz(paths):
+    # A legacy .csv Points file is only used if there is no .npz file of the same name
+    stems = {os.path.splitext(p)[0] for p in paths if p.endswith(".npz")}
+    return [p for p in paths if not (p.endswith(".csv") and os.path.splitext(p)[0] in stems)]
+
+def is_replicate_dir(path):
+    from replicate_store import find_replicate_store
+    return find_replicate_store(path) is not None or any(d.startswith("replicate_") for d in os.listdir(path))
+
+def expand_replicate_dirs(inputs, label):
+    # Replicate directories (see generate_replicates) from directories, their parent directories and glob patterns.
+    # Inputs that do not exist are reported and skipped; returns the directories and the number of missing inputs.
+    dirs = []
+    missing = 0
+    for item in inputs:
+        if not glob.has_magic(item) and not os.path.exists(item):
+            print(f"[{label}] input not found: {item}", file=sys.stderr)
+            missing += 1
+            continue
+        for match in (sorted(glob.glob(item, recursive=True)) if glob.has_magic(item) else [item]):
+            if not os.path.isdir(match):
+                continue
+            if is_replicate_dir(match):
+                dirs.append(match)
+            else:
+                dirs.extend(os.path.join(match, d) for d in sorted(os.listdir(match))
+                            if os.path.isdir(os.path.join(match, d)) and is_replicate_dir(os.path.join(match, d)))
+    return list(dict.fromkeys(dirs)), missing
+
+def number(text):
+    # A number, integral values as int
+    value = float(text)
+    return int(value) if value.is_integer() else value
+
+def parse_numbers(text):
+    # Comma-separated numbers
+    return [number(v) for v in text.split(",")]
+
+def parse_bandwidth(text):
+    # One bandwidth, or a list of them for several comma-separated values
+    bws = parse_numbers(text)
+    return bws[0] if len(bws) == 1 else bws
+
+def run_all(items, label, task, missing=0):
+    # Runs the task on every item; a failing item is reported and skipped so the others still run.
+    # Returns the number of failures, counting the missing inputs (see expand_inputs).
+    if not items:
+        print(f"[{label}] no inputs found", file=sys.stderr)
+        return max(missing, 1)
+    failures = missing
+    for i, item in enumerate(items, 1):
+        print(f"[{label} {i}/{len(items)}] {item}", flush=True)
+        try:
+            task(item)
+        except Exception:
+            failures += 1
+            traceback.print_exc()
+    return failures
+
+def cmd_points(args):
+    from generate_points_multiprocessing import generate_points_multiprocessing
+    os.makedirs(args.output, exist_ok=True)
+
+    def task(image_path):
+        file_path = os.path.join(args.output, os.path.splitext(os.path.basename(image_path))[0] + ".npz")
+        counts = generate_points_multiprocessing([image_path, file_path, args.k, False], num_workers=args.workers,
+                                                 dense=args.dense, tiled=args.tiled, tile_size=args.tile_size,
+                                                 export_csv=args.csv)
+        print(f"  {counts['points']} points saved to {file_path} ({counts['skipped']} pixels skipped)")
+
+    images, missing = expand_inputs(args.inputs, IMAGE_EXTENSIONS, "points")
+    return run_all(images, "points", task, missing)
+
+def cmd_replicates(args):
+    from generate_replicates import generate_replicates
+
+    def task(points_path):
+        output_dir = os.path.join(args.output, os.path.splitext(os.path.basename(points_path))[0])
+        os.makedirs(output_dir, exist_ok=True)
+        generate_replicates([points_path, output_dir, args.replicates], export_csv=args.csv)
+        print(f"  replicates saved to {output_dir}")
+
+    points, missing = expand_inputs(args.inputs, POINTS_EXTENSIONS, "replicates")
+    return run_all(prefer_npz(points), "replicates", task, missing)
+
+def cmd_test(args):
+    bw = parse_bandwidth(args.bw)
+
+    if args.from_points:
+        # Replicates are drawn and tested in memory (see replicate_bimodality), without replicate directories
+        from replicate_bimodality import replicate_bimodality
+
+        def task(points_path):
+            name = os.path.splitext(os.path.basename(points_path))[0]
+            output_dir = args.output if args.output else os.path.dirname(os.path.abspath(points_path))
+            os.makedirs(output_dir, exist_ok=True)
+            out_path = os.path.join(output_dir, f"{name}_bimodality_results.csv")
+            replicate_bimodality([points_path, args.replicates, bw, out_path],
+                                 persist_dir=output_dir if args.keep_replicates else None, export_csv=args.csv,
+                                 backend=args.backend, num_workers=args.workers)
+            print(f"  results saved to {out_path}")
+
+        points, missing = expand_inputs(args.inputs, POINTS_EXTENSIONS, "test")
+        return run_all(prefer_npz(points), "test", task, missing)
+
+    from check_bimodality_across_replicates import check_bimodality_across_replicates
+
+    def task(folder):
+        name = os.path.basename(os.path.normpath(folder))
+        output_dir = args.output if args.output else folder
+        os.makedirs(output_dir, exist_ok=True)
+        out_path = os.path.join(output_dir, f"{name}_bimodality_results.csv")
+        check_bimodality_across_replicates([folder, bw, out_path], backend=args.backend, num_workers=args.workers)
+        print(f"  results saved to {out_path}")
+
+    folders, missing = expand_replicate_dirs(args.inputs, "test")
+    return run_all(folders, "test", task, missing)
+
+def cmd_significance(args):
+    from bimodality_significance import bimodality_significance_batch
+    # The results of 'test' are in the replicate directories, so directories are searched recursively
+    unknowns, missing = expand_inputs(args.inputs, ("_bimodality_results.csv",), "significance", recursive=True)
+    if not unknowns:
+        print("[significance] no inputs found", file=sys.stderr)
+        return 1
+    if missing:
+        return 1
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    try:
+        df = bimodality_significance_batch(unknowns, args.controls, parse_numbers(args.meanders), args.output, args.bw)
+    except ValueError as e:
+        print(f"[significance] {e}", file=sys.stderr)
+        return 1
+    print(f"p-values of {df['unknown'].nunique()} unknowns saved to {args.output}")
+    return 0
+
+def cmd_calibrate(args):
+    from optimize_bandwidth import optimize_bandwidth, save_optimal_bandwidth
+    if not glob.glob(os.path.join(args.calibration, "bimodality_calibration_set*.csv")):
+        print(f"[calibrate] no bimodality_calibration_set*.csv files in {args.calibration}", file=sys.stderr)
+        return 1
+    bw = optimize_bandwidth(args.calibration, args.sgr, backend=args.backend, refine=args.refine,
+                            num_workers=args.workers)
+    bw = number(bw)
+    print(f"Optimal bandwidth: {bw}")
+    if args.save:
+        save_optimal_bandwidth(args.calibration, bw)
+    return 0
+
+def cmd_controls(args):
+    from build_control_set import build_control_set
+    built = build_control_set(args.input, args.output, args.controls, args.bw, args.replicates,
+                              backend=args.backend, num_workers=args.workers, seed=args.seed)
+    print(f"Control set saved to {args.controls} "
+          f"({len(built['built'])} rivers built, {len(built['up_to_date'])} up to date)")
+    return 0
+
+def cmd_startup(args):
+    from startup_time import measure_startup
+    results = measure_startup(args.repeats, args.output)
+    for target, seconds in results.items():
+        print(f"{target:20s} {seconds:6.3f} s")
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Bimodality test of river flow directions, without the GUI.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def workers(p):
+        p.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: all CPUs)")
+
+    def backend(p):
+        p.add_argument("--backend", choices=["sklearn", "wrapped", "fft"], default="sklearn",
+                       help="KDE backend of the bimodality test")
+
+    p = subparsers.add_parser("points", help="sample points from river images")
+    p.add_argument("inputs", nargs="+", help="images, directories of images or glob patterns")
+    p.add_argument("-k", type=int, required=True, help="number of points per image")
+    p.add_argument("-o", "--output", required=True, help="directory of the Points files (one .npz file per image)")
+    p.add_argument("--dense", action="store_true", help="draw the points from the dense flow field")
+    p.add_argument("--tiled", action="store_true",
+                   help="process very large images in memory-mapped tiles (TIFF and .npy images are read piece by "
+                        "piece, other formats are decoded as a whole and limited to PIL's MAX_IMAGE_PIXELS)")
+    p.add_argument("--tile-size", type=int, default=2048, help="tile size in pixels for --tiled")
+    p.add_argument("--csv", action="store_true", help="also export the Points files as CSV")
+    workers(p)
+    p.set_defaults(func=cmd_points)
+
+    p = subparsers.add_parser("replicates", help="draw the replicates of Points files")
+    p.add_argument("inputs", nargs="+", help="Points files (.npz or .csv), directories or glob patterns")
+    p.add_argument("-o", "--output", required=True, help="directory of the replicate directories (one per Points file)")
+    p.add_argument("-n", "--replicates", type=int, default=100, help="number of replicates")
+    p.add_argument("--csv", action="store_true", help="also export every cohort as a CSV file")
+    p.set_defaults(func=cmd_replicates)
+
+    p = subparsers.add_parser("test", help="apply the bimodality test to replicate directories")
+    p.add_argument("inputs", nargs="+",
+                   help="replicate directories, their parent directories or glob patterns "
+                        "(Points files, directories or glob patterns with --from-points)")
+    p.add_argument("--bw", default="8", help="bandwidth, or comma-separated bandwidths")
+    p.add_argument("-o", "--output", default=None,
+                   help="directory of the results files (default: the replicate directory, "
+                        "or the directory of the Points file with --from-points)")
+    p.add_argument("--from-points", action="store_true",
+                   help="draw the replicates of Points files and test them in memory, without replicate directories")
+    p.add_argument("-n", "--replicates", type=int, default=100, help="number of replicates for --from-points")
+    p.add_argument("--keep-replicates", action="store_true",
+                   help="with --from-points, also save the replicate store next to the results for auditing")
+    p.add_argument("--csv", action="store_true", help="with --keep-replicates, also export every cohort as a CSV file")
+    backend(p)
+    workers(p)
+    p.set_defaults(func=cmd_test)
+
+    p = subparsers.add_parser("significance", help="test bimodality results against a control set")
+    p.add_argument("inputs", nargs="+", help="*_bimodality_results.csv files, directories or glob patterns")
+    p.add_argument("-c", "--controls", required=True, help="controls CSV file")
+    p.add_argument("-m", "--meanders", default="0",
+                   help="number of meanders, or comma-separated numbers (0: test per sample count)")
+    p.add_argument("-o", "--output", required=True, help="CSV file of the combined p-value table")
+    p.add_argument("--bw", type=number, default=None,
+                   help="bandwidth to test, required for results of several bandwidths (test --bw with a list)")
+    p.set_defaults(func=cmd_significance)
+
+    p = subparsers.add_parser("calibrate", help="find the optimal bandwidth of the bimodality test")
+    p.add_argument("--calibration", default=os.path.join(script_path, "bimodality_calibration"),
+                   help="directory of the calibration sets")
+    p.add_argument("--sgr", default=os.path.join(script_path, "sgr"), help="directory of the sine-generated rivers")
+    p.add_argument("--refine", type=int, default=2, help="number of refinements of the bandwidth grid")
+    p.add_argument("--save", action="store_true", help="add the bandwidth to optimal_bandwidth.csv")
+    backend(p)
+    workers(p)
+    p.set_defaults(func=cmd_calibrate)
+
+    p = subparsers.add_parser("controls", help="build a control set from the Points files of control rivers")
+    p.add_argument("input", help="directory of the Points files of the control rivers")
+    p.add_argument("-o", "--output", required=True, help="directory of the results of every control river")
+    p.add_argument("-c", "--controls", required=True, help="CSV file of the control set")
+    p.add_argument("--bw", type=number, default=8, help="bandwidth")
+    p.add_argument("-n", "--replicates", type=int, default=100, help="number of replicates")
+    p.add_argument("--seed", type=int, default=None, help="random seed, for a reproducible control set")
+    backend(p)
+    workers(p)
+    p.set_defaults(func=cmd_controls)
+
+    p = subparsers.add_parser("startup", help="measure the cold-start time of the GUI, this interface and the pool workers")
+    p.add_argument("-n", "--repeats", type=int, default=3, help="number of runs, the fastest one counts")
+    p.add_argument("-o", "--output", default=None, help="CSV file the results are appended to")
+    p.set_defaults(func=cmd_startup)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    failures = args.func(args)
+    if failures:
+        print(f"{failures} error(s)", file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+    sys.exit(main())
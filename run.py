@@ -7,12 +7,8 @@ import re
 import glob
 import sys
 from datetime import datetime
-import pandas as pd
 import matplotlib
-matplotlib.use("TkAgg")
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from PIL import Image
+matplotlib.use("TkAgg")  # interactive backend for all plots shown from the GUI
 
 # Setup paths and imports
 if getattr(sys, 'frozen', False):
@@ -24,13 +20,8 @@ else:
 
 sys.path.append(os.path.join(script_path, 'utils'))
 
-# Local imports
-from generate_points_multiprocessing import generate_points_multiprocessing  # type: ignore
-from generate_replicates import generate_replicates  # type: ignore
-from check_bimodality_across_replicates import check_bimodality_across_replicates  # type: ignore
-from bimodality_significance import bimodality_significance  # type: ignore
-from classify_rosediagrams_manually import classify_rosediagrams_manually  # type: ignore
-from optimize_bandwidth import optimize_bandwidth  # type: ignore
+# The pipeline modules (and pandas, pyplot, scikit-learn, ...) are imported when a window runs them,
+# so the GUI and the worker processes, which re-import this script on Windows, start quickly.
 
 # Utility function
 
@@ -41,6 +32,11 @@ def validate_name(name):
         return False, "Only letters, numbers, and underscores allowed."
     return True, ""
 
+def parse_bandwidth(text):
+    # A bandwidth entered or selected in a window, integral values as int
+    bw = float(text)
+    return int(bw) if bw.is_integer() else bw
+
 # GUI Functions
 
 def show_upload_window(root):
@@ -119,7 +115,17 @@ def show_generate_points_window(root):
     plot_var = tk.IntVar()
     tk.Checkbutton(win, text="Plot Results", variable=plot_var).pack()
 
+    dense_var = tk.IntVar()
+    tk.Checkbutton(win, text="Dense Flow Field", variable=dense_var).pack()
+
+    tiled_var = tk.IntVar()
+    tk.Checkbutton(win, text="Tiled (Very Large TIFF or .npy Images)", variable=tiled_var).pack()
+
+    csv_var = tk.IntVar()
+    tk.Checkbutton(win, text="Also Export CSV", variable=csv_var).pack()
+
     def run():
+        from generate_points_multiprocessing import generate_points_multiprocessing  # type: ignore
         folder = folder_var.get()
         image = image_var.get()
         k = k_entry.get()
@@ -133,11 +139,17 @@ def show_generate_points_window(root):
             return messagebox.showerror("Invalid Filename", msg)
 
         image_path = os.path.join(script_path, folder, "Images", image)
-        file_path = os.path.join(script_path, folder, "Points", f"{filename}.csv")
+        file_path = os.path.join(script_path, folder, "Points", f"{filename}.npz")
 
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        generate_points_multiprocessing([image_path, file_path, int(k), bool(plot_var.get())])
-        messagebox.showinfo("Success", f"Points saved to {file_path}")
+        try:
+            counts = generate_points_multiprocessing([image_path, file_path, int(k), bool(plot_var.get())],
+                                                     dense=bool(dense_var.get()), tiled=bool(tiled_var.get()),
+                                                     export_csv=bool(csv_var.get()))
+        except ValueError as e:
+            return messagebox.showerror("Error", str(e))
+        messagebox.showinfo("Success", f"Points saved to {file_path}\n"
+                                       f"({counts['skipped']} drawn pixels without a valid flow direction skipped)")
 
     tk.Button(win, text="Run", command=run).pack(pady=10)
 
@@ -153,22 +165,26 @@ def show_bimodality_test_window(root):
         tk.Label(win, text="Select Data File:").pack()
         selected_dir = os.path.join(script_path, "my_unknowns", "Points")
         os.makedirs(selected_dir, exist_ok=True)
-        file_names = [f for f in os.listdir(selected_dir) if f.endswith(".csv")]
+        file_names = [f for f in os.listdir(selected_dir) if f.endswith((".npz", ".csv"))]
 
         file_dropdown = ttk.Combobox(win, values=file_names)
         file_dropdown.pack()
 
+        export_var = tk.IntVar()
+        tk.Checkbutton(win, text="Also Export Cohort CSVs", variable=export_var).pack()
+
         status_label = tk.Label(win, text="")
         status_label.pack()
 
         def run():
+            from generate_replicates import generate_replicates  # type: ignore
             selected_file = file_dropdown.get()
             if not selected_file:
                 return status_label.config(text="Please select a file.")
             input_path = os.path.join(selected_dir, selected_file)
             output_dir = os.path.join(script_path, "my_bimodality_tests", "Unknowns", os.path.splitext(selected_file)[0])
             os.makedirs(output_dir, exist_ok=True)
-            generate_replicates([input_path, output_dir, 100])
+            generate_replicates([input_path, output_dir, 100], export_csv=bool(export_var.get()))
             status_label.config(text=f"Replicates in {output_dir}")
 
         tk.Button(win, text="Run", command=run).pack()
@@ -184,7 +200,7 @@ def show_bimodality_test_window(root):
         dir_dropdown.pack()
 
         use_custom_var = tk.BooleanVar(value=True)
-        tk.Radiobutton(win, text="Enter Custom Bandwidth:", variable=use_custom_var, value=True).pack()
+        tk.Radiobutton(win, text="Enter Custom Bandwidth(s), comma-separated:", variable=use_custom_var, value=True).pack()
         custom_bw_entry = tk.Entry(win)
         custom_bw_entry.insert(0, "8")
         custom_bw_entry.pack()
@@ -192,6 +208,7 @@ def show_bimodality_test_window(root):
         tk.Radiobutton(win, text="Select Bandwidth from Calibrations:", variable=use_custom_var, value=False).pack()
         bw_options = []
         try:
+            import pandas as pd
             df = pd.read_csv(os.path.join(script_path, "bimodality_calibration", "optimal_bandwidth.csv"))
             bw_options = df["Optimal bandwidth"].dropna().unique().tolist()
         except: pass
@@ -203,8 +220,12 @@ def show_bimodality_test_window(root):
 
         def get_bw():
             try:
-                return int(custom_bw_entry.get()) if use_custom_var.get() else int(float(dropdown_var.get()))
-            except:
+                if not use_custom_var.get():
+                    return parse_bandwidth(dropdown_var.get())
+                # several bandwidths are evaluated in one pass (results get a bandwidth column)
+                bws = [parse_bandwidth(b) for b in custom_bw_entry.get().split(",")]
+                return bws[0] if len(bws) == 1 else bws
+            except ValueError:
                 status_label.config(text="Invalid bandwidth.")
                 return None
 
@@ -213,9 +234,55 @@ def show_bimodality_test_window(root):
             if not d: return status_label.config(text="Please select dir.")
             bw = get_bw()
             if bw is None: return
+            from check_bimodality_across_replicates import check_bimodality_across_replicates  # type: ignore
             folder = os.path.join(script_path, "my_bimodality_tests", "Unknowns", d)
             out_path = os.path.join(folder, f"{d}_bimodality_results.csv")
-            check_bimodality_across_replicates([folder, bw, out_path])
+            check_bimodality_across_replicates([folder, bw, out_path], num_workers=None)
+            status_label.config(text=f"Saved to {out_path}")
+
+        tk.Button(win, text="Run", command=run).pack()
+
+    def open_replicate_and_test_window():
+        # Draws the replicates of a Points file and tests them in one step, without replicate files
+        win = tk.Toplevel(bimodality_window)
+        win.title("Replicate and Test")
+
+        tk.Label(win, text="Select Data File:").pack()
+        selected_dir = os.path.join(script_path, "my_unknowns", "Points")
+        os.makedirs(selected_dir, exist_ok=True)
+        file_names = [f for f in os.listdir(selected_dir) if f.endswith((".npz", ".csv"))]
+        file_dropdown = ttk.Combobox(win, values=file_names)
+        file_dropdown.pack()
+
+        tk.Label(win, text="Enter Bandwidth(s), comma-separated:").pack()
+        bw_entry = tk.Entry(win)
+        bw_entry.insert(0, "8")
+        bw_entry.pack()
+
+        keep_var = tk.IntVar()
+        tk.Checkbutton(win, text="Save Replicates for Auditing", variable=keep_var).pack()
+        export_var = tk.IntVar()
+        tk.Checkbutton(win, text="Also Export Cohort CSVs", variable=export_var).pack()
+
+        status_label = tk.Label(win, text="")
+        status_label.pack()
+
+        def run():
+            selected_file = file_dropdown.get()
+            if not selected_file:
+                return status_label.config(text="Please select a file.")
+            try:
+                bws = [parse_bandwidth(b) for b in bw_entry.get().split(",")]
+            except ValueError:
+                return status_label.config(text="Invalid bandwidth.")
+            from replicate_bimodality import replicate_bimodality  # type: ignore
+            name = os.path.splitext(selected_file)[0]
+            folder = os.path.join(script_path, "my_bimodality_tests", "Unknowns", name)
+            os.makedirs(folder, exist_ok=True)
+            out_path = os.path.join(folder, f"{name}_bimodality_results.csv")
+            replicate_bimodality([os.path.join(selected_dir, selected_file), 100, bws[0] if len(bws) == 1 else bws,
+                                  out_path], persist_dir=folder if keep_var.get() else None,
+                                 export_csv=bool(export_var.get()), num_workers=None)
             status_label.config(text=f"Saved to {out_path}")
 
         tk.Button(win, text="Run", command=run).pack()
@@ -234,6 +301,10 @@ def show_bimodality_test_window(root):
         meanders_entry = tk.Entry(win)
         meanders_entry.pack()
 
+        tk.Label(win, text="Bandwidth (only for results of several bandwidths):").pack()
+        sig_bw_entry = tk.Entry(win)
+        sig_bw_entry.pack()
+
         tk.Button(win, text="Show Image", command=lambda: show_image(result_dropdown.get())).pack()
 
         tk.Label(win, text="Select Control File:").pack()
@@ -245,6 +316,7 @@ def show_bimodality_test_window(root):
         status_label.pack()
 
         def show_image(filename):
+            import matplotlib.pyplot as plt
             basename = filename.replace("_bimodality_results.csv", "")
             img_path = os.path.join(script_path, "my_unknowns", "Images", f"{basename}.png")
             if os.path.exists(img_path):
@@ -258,6 +330,11 @@ def show_bimodality_test_window(root):
             else:
                 status_label.config(text="Image not found.")
 
+        def get_bw():
+            # None if no bandwidth is entered; raises ValueError for an invalid one
+            text = sig_bw_entry.get().strip()
+            return parse_bandwidth(text) if text else None
+
         def run():
             file = result_dropdown.get()
             if not file: return status_label.config(text="No bimodality file.")
@@ -269,6 +346,10 @@ def show_bimodality_test_window(root):
                 n_meanders = int(meanders_entry.get())
             except:
                 return status_label.config(text="Invalid meanders.")
+            try:
+                bw = get_bw()
+            except ValueError:
+                return status_label.config(text="Invalid bandwidth.")
             ctrl_file = control_dropdown.get()
             if not ctrl_file:
                 return status_label.config(text="No control file.")
@@ -276,18 +357,47 @@ def show_bimodality_test_window(root):
             ctrl_path = os.path.join(script_path, "control_files", ctrl_file)
 
             try:
-                bimodality_significance(upath, ctrl_path, n_meanders)
+                from bimodality_significance import bimodality_significance  # type: ignore
+                bimodality_significance(upath, ctrl_path, n_meanders, bw)
                 status_label.config(text=f"Completed for {file}")
             except Exception as e:
                 status_label.config(text=f"Error: {e}")
 
+        def run_all():
+            # every unknown against the selected control file, for one or more (comma-separated) numbers of meanders
+            try:
+                n_meanders = [int(m) for m in meanders_entry.get().split(",")]
+            except ValueError:
+                return status_label.config(text="Invalid meanders.")
+            try:
+                bw = get_bw()
+            except ValueError:
+                return status_label.config(text="Invalid bandwidth.")
+            ctrl_file = control_dropdown.get()
+            if not ctrl_file:
+                return status_label.config(text="No control file.")
+
+            ctrl_path = os.path.join(script_path, "control_files", ctrl_file)
+            unknowns_dir = os.path.join(script_path, "my_bimodality_tests", "Unknowns")
+            out_path = os.path.join(unknowns_dir, f"all_p_values_{datetime.now().strftime('%m%d%y_%H%M')}.csv")
+
+            try:
+                from bimodality_significance import bimodality_significance_batch  # type: ignore
+                df = bimodality_significance_batch(os.path.join(unknowns_dir, "**", "*_bimodality_results.csv"),
+                                                   ctrl_path, n_meanders, out_path, bw)
+                status_label.config(text=f"Completed for {df['unknown'].nunique()} unknowns")
+            except Exception as e:
+                status_label.config(text=f"Error: {e}")
+
         tk.Button(win, text="Run", command=run).pack()
+        tk.Button(win, text="Run for All Unknowns", command=run_all).pack()
 
     def open_calibrate_bimodality_window():
         win = tk.Toplevel(bimodality_window)
         win.title("Calibrate Bimodality Test")
 
         def make_set():
+            from classify_rosediagrams_manually import classify_rosediagrams_manually  # type: ignore
             if not messagebox.askokcancel("Instructions", "Classify river plots manually. Proceed?"): return
             input_dir = os.path.join(script_path, "sgr")
             output_dir = os.path.join(script_path, "bimodality_calibration")
@@ -299,28 +409,15 @@ def show_bimodality_test_window(root):
             messagebox.showinfo("Done", f"Saved to {output_path}")
 
         def optimize():
+            from optimize_bandwidth import optimize_bandwidth, save_optimal_bandwidth  # type: ignore
             calibration_dir = os.path.join(script_path, "bimodality_calibration")
             sgr_dir = os.path.join(script_path, "sgr")
-            bw = optimize_bandwidth(calibration_dir, sgr_dir, plot_var.get())
+            # integer grid 1-15, refined twice around the best bandwidth
+            bw = float(optimize_bandwidth(calibration_dir, sgr_dir, plot_var.get(), refine=2, num_workers=None))
 
             if messagebox.askyesno(title="Bandwidth Optimization Complete",
                                    message=f"Optimal bandwidth is {bw}. Save this value?"):
-                file_path = os.path.join(calibration_dir, "optimal_bandwidth.csv")
-                d = datetime.today().strftime("%Y-%m-%d")
-                if os.path.exists(file_path):
-                    df = pd.read_csv(file_path)
-                else:
-                    df = pd.DataFrame(columns=["Date", "Type", "Optimal bandwidth"])
-                if bw not in df["Optimal bandwidth"].values:
-                    new_row = pd.DataFrame({
-                        "Date": [d],
-                        "Type": ["user-defined"],
-                        "Optimal bandwidth": [bw]
-                    })
-                    df = pd.concat([df, new_row], ignore_index=True)
-                else:
-                    df.loc[df["Optimal bandwidth"] == bw, "Date"] = d
-                df.to_csv(file_path, index=False)
+                file_path = save_optimal_bandwidth(calibration_dir, bw)
                 messagebox.showinfo("Saved", f"Saved to {file_path}")
 
         plot_var = tk.BooleanVar()
@@ -340,57 +437,53 @@ def show_bimodality_test_window(root):
 
         tk.Radiobutton(win, text="Select Bandwidth from Calibrations:", variable=use_custom_var, value=False).pack()
         try:
+            import pandas as pd
             bw_path = os.path.join(script_path, "bimodality_calibration", "optimal_bandwidth.csv")
             bw_opts = pd.read_csv(bw_path)["Optimal bandwidth"].dropna().unique().tolist()
         except: bw_opts = []
         dropdown_var = tk.StringVar()
         tk.OptionMenu(win, dropdown_var, *(bw_opts if bw_opts else ["No options"])).pack()
 
+        tk.Label(win, text="Random Seed (optional):").pack()
+        seed_entry = tk.Entry(win)
+        seed_entry.pack()
+
         status_label = tk.Label(win, text="")
         status_label.pack()
 
         def get_bw():
             try:
-                return int(custom_bw_entry.get()) if use_custom_var.get() else int(float(dropdown_var.get()))
-            except:
+                return parse_bandwidth(custom_bw_entry.get() if use_custom_var.get() else dropdown_var.get())
+            except ValueError:
                 status_label.config(text="Invalid bandwidth.")
                 return None
 
         def run():
             bw = get_bw()
             if bw is None: return
+            try:
+                # the same seed gives the same control set
+                seed = int(seed_entry.get()) if seed_entry.get().strip() else None
+            except ValueError:
+                return status_label.config(text="Invalid seed.")
             if not messagebox.askokcancel("Warning", "This may take a while."): return
-
+            from build_control_set import build_control_set  # type: ignore
             input_dir = os.path.join(script_path, "my_controls", "Points")
             output_dir = os.path.join(script_path, "my_bimodality_tests", "Controls")
             if not os.path.exists(input_dir) or not os.listdir(input_dir):
                 return messagebox.showerror("Error", "my_controls/Points is empty")
-            os.makedirs(output_dir, exist_ok=True)
-            for f in os.listdir(input_dir):
-                if f.endswith(".csv"):
-                    src = os.path.join(input_dir, f)
-                    dest = os.path.join(output_dir, os.path.splitext(f)[0])
-                    os.makedirs(dest, exist_ok=True)
-                    generate_replicates([src, dest, 100])
-                    result_file = os.path.join(dest, f"{os.path.basename(dest)}_bimodality_results.csv")
-                    check_bimodality_across_replicates([dest, bw, result_file])
-
-            all_results = [pd.read_csv(os.path.join(r, f))
-                           for r, _, fs in os.walk(output_dir)
-                           for f in fs if f.endswith("bimodality_results.csv")]
-            if all_results:
-                outdf = pd.concat(all_results)
-                outpath = os.path.join(script_path, "control_files", f"user_controls_{datetime.now().strftime('%m%d%y')}.csv")
-                outdf.to_csv(outpath, index=False)
-                messagebox.showinfo("Success", f"Control set saved to {outpath}")
-            else:
-                messagebox.showerror("Error", "No result files found.")
+            outpath = os.path.join(script_path, "control_files", f"user_controls_{datetime.now().strftime('%m%d%y')}.csv")
+            # rivers are processed in parallel; rivers whose Points file and parameters did not change are reused
+            built = build_control_set(input_dir, output_dir, outpath, bw, 100, num_workers=None, seed=seed)
+            messagebox.showinfo("Success", f"Control set saved to {outpath}\n"
+                                           f"{len(built['built'])} rivers built, {len(built['up_to_date'])} up to date")
 
         tk.Button(win, text="Run", command=run).pack()
 
     # Main options
     tk.Button(bimodality_window, text="Generate Replicates", command=open_generate_replicates_window).pack()
     tk.Button(bimodality_window, text="Apply Bimodality Test", command=open_apply_bimodality_test_window).pack()
+    tk.Button(bimodality_window, text="Replicate and Test", command=open_replicate_and_test_window).pack()
     tk.Button(bimodality_window, text="Statistical Significance", command=open_statistical_significance_window).pack()
     tk.Button(bimodality_window, text="Calibrate Bimodality Test", command=open_calibrate_bimodality_window).pack()
     tk.Button(bimodality_window, text="Make New Control Set", command=open_make_new_control_set_window).pack()
@@ -0,0 +1,98 @@
+import numpy as np
+from scipy import ndimage
+
+# The banks of a river are the regions on either side of its skeleton. They are labelled once per
+# image, so that "is there a path between these points that does not cross the skeleton" (see
+# find_path) becomes a label comparison.
+# The skeleton alone does not split a river: its tips stop about half a river width short of the
+# river's ends (or of the image edge), and the banks meet around them. The tips are therefore
+# extended along the skeleton until they leave the river. Like find_path, the banks may also pass
+# through the background right next to the river, so that a bank that is only one pixel wide is not
+# cut into pieces where the skeleton touches the contour.
+EIGHT = np.ones((3, 3), dtype=bool)
+
+def skeleton_tips(skeleton, trace=8):
+    # End points of the skeleton branches that are at least trace pixels long, with the direction in
+    # which the skeleton leaves them (from the pixel trace steps back along the branch to the tip).
+    # Shorter branches are spurs or bits of noise and are not extended.
+    skeleton = skeleton > 0
+    rows, cols = skeleton.shape
+    degree = ndimage.convolve(skeleton.astype(np.uint8), EIGHT.astype(np.uint8), mode='constant') - 1
+
+    tips = []
+    for tip in np.argwhere(skeleton & (degree == 1)):
+        previous, current = None, tuple(tip)
+        for _ in range(trace):
+            r, c = current
+            following = [(r + dr, c + dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1)
+                         if (dr or dc) and 0 <= r + dr < rows and 0 <= c + dc < cols
+                         and skeleton[r + dr, c + dc] and (r + dr, c + dc) != previous]
+            if len(following) != 1:
+                break
+            previous, current = current, following[0]
+        else:
+            direction = tip - np.array(current)
+            tips.append((tip, direction / np.hypot(*direction)))
+    return tips
+
+def close_diagonals(barrier):
+    # Fills one of the two side pixels of every diagonal step, so that 8-connected regions cannot
+    # leak through the barrier
+    barrier = barrier.copy()
+    step = barrier[:-1, :-1] & barrier[1:, 1:] & ~barrier[:-1, 1:] & ~barrier[1:, :-1]
+    barrier[:-1, 1:] |= step
+    step = barrier[:-1, 1:] & barrier[1:, :-1] & ~barrier[:-1, :-1] & ~barrier[1:, 1:]
+    barrier[:-1, :-1] |= step
+    return barrier
+
+def bank_region(tg_binary, margin=2):
+    # River pixels plus the background pixels within margin pixels of the river
+    return ndimage.binary_dilation(tg_binary > 0, EIGHT, iterations=margin) if margin else tg_binary > 0
+
+def bank_barrier(region, skeleton, reach=3.0, trace=8):
+    # Skeleton plus its extended tips, as a 4-connected barrier.
+    # A tip is extended in a straight line until it leaves the region or the image. The extension is
+    # dropped if that takes more than reach times the distance of the tip to the edge of the region
+    # (a tip in open water, far from any river end).
+    barrier = skeleton > 0
+    rows, cols = barrier.shape
+    depth = ndimage.distance_transform_edt(np.pad(region, 1))[1:-1, 1:-1]
+
+    for tip, direction in skeleton_tips(skeleton, trace):
+        line = []
+        for step in range(1, int(reach * depth[tip[0], tip[1]]) + 3):
+            r, c = np.rint(tip + step * direction).astype(int)
+            if not (0 <= r < rows and 0 <= c < cols) or not region[r, c]:
+                for pixel in line:
+                    barrier[pixel] = True
+                break
+            line.append((r, c))
+    return close_diagonals(barrier)
+
+def fill_barrier(labels, pixels):
+    # Gives the barrier pixels that are not on the skeleton the label of the nearest labelled pixel,
+    # so that points sampled on them still have a bank
+    if pixels.any() and labels.any():
+        _, (rows, cols) = ndimage.distance_transform_edt(labels <= 0, return_indices=True)
+        labels[pixels] = labels[rows[pixels], cols[pixels]]
+    return labels
+
+def label_banks(tg_binary, skeleton, margin=2):
+    # Splits the river into its banks (8-connected regions on either side of the barrier, see bank_barrier).
+    # Pixels outside the river and on the skeleton get label 0.
+    region = bank_region(tg_binary, margin)
+    barrier = bank_barrier(region, skeleton)
+    labels, _ = ndimage.label(region & ~barrier, structure=EIGHT)
+    labels = fill_barrier(labels, region & barrier & (skeleton == 0))
+    labels[tg_binary == 0] = 0
+    return labels
+
+def same_bank(labels, starts, goals):
+    # Checks for many pairs of points at once whether there is a path between them
+    # that stays in the river and does not cross the skeleton.
+    # starts, goals: arrays of shape (k, 2), or a single point each.
+    starts = np.asarray(starts).reshape(-1, 2)
+    goals = np.asarray(goals).reshape(-1, 2)
+    start_labels = labels[starts[:, 0], starts[:, 1]]
+    goal_labels = labels[goals[:, 0], goals[:, 1]]
+    return (start_labels > 0) & (start_labels == goal_labels)
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from utils.check_bimodality import kernel_basis, check_bimodality_batch
+
+def cohort_matrix(indices, cohort_sizes, n_points):
+    # Sparse matrix that averages the rows of each cohort: one row per replicate and cohort size
+    # (replicate after replicate), one column per point.
+    n_replicates = len(indices)
+    n_cohorts = len(cohort_sizes)
+    sizes = np.tile(np.repeat(cohort_sizes, cohort_sizes), n_replicates)
+    rows = np.repeat(np.arange(n_replicates * n_cohorts), np.tile(cohort_sizes, n_replicates))
+    return csr_matrix(((1 / sizes).astype(np.float32), (rows, np.ravel(indices))),
+                      shape=(n_replicates * n_cohorts, n_points))
+
+def results_table(name, samples, replicates, bimodal, bw):
+    # Results table of the bimodality test, one row per cohort. For a list of bandwidths
+    # (bimodal has one row per bandwidth) there is one row per bandwidth and cohort,
+    # with an additional bandwidth column.
+    if np.ndim(bw) == 0:
+        return pd.DataFrame({
+            'name': name,
+            'samples': samples,
+            'bimodal': bimodal,
+            'replicate': replicates,
+            }, columns=['name', 'samples', 'bimodal', 'replicate'])
+
+    return pd.DataFrame({
+        'name': name,
+        'samples': np.tile(samples, len(bw)),
+        'bimodal': np.ravel(bimodal),
+        'replicate': np.tile(replicates, len(bw)),
+        'bandwidth': np.repeat(bw, len(samples)),
+        }, columns=['name', 'samples', 'bimodal', 'replicate', 'bandwidth'])
+
+def bimodality_of_replicates(name, store, bw):
+    # Applies the bimodality test to all cohorts of a replicate store (see replicate_store.py),
+    # using the wrapped KDE backend. The kernel of every point is evaluated once (per bandwidth)
+    # and the KDEs of all cohorts are computed with a single matrix product.
+    # Returns the same table as check_bimodality_across_replicates.
+    x_vals = np.linspace(-90, 90, 1000)
+    angles = (store['angle'] + 90) % 180 - 90
+    cohort_sizes = store['cohort_sizes']
+    indices = store['indices']
+    n_replicates = len(indices)
+
+    # Test all cohorts at once, in the order of the rows of kdes
+    averaging = cohort_matrix(indices, cohort_sizes, len(angles))
+    offsets = np.concatenate([[0], np.cumsum(np.tile(cohort_sizes, n_replicates))])
+    cohort_angles = angles[np.ravel(indices)]
+
+    bimodal = []
+    for b in np.atleast_1d(bw):
+        kdes = averaging @ kernel_basis(angles, x_vals, b)
+        bimodal.append(check_bimodality_batch(cohort_angles, offsets, b, True, 'wrapped', kdes)[0])
+
+    return results_table(name, np.tile(cohort_sizes, n_replicates).astype(int),
+                         np.repeat(np.arange(1, n_replicates + 1), len(cohort_sizes)),
+                         bimodal[0] if np.ndim(bw) == 0 else np.array(bimodal), bw)
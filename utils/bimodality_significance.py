@@ -1,60 +1,86 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from scipy.stats import norm, gaussian_kde
+from scipy.special import ndtr
 import os
-
-
-def bimodality_significance(unknown_path, controls_path, n_meanders):
-    sample_densities_to_save = [2, 3, 4, 5, 10, 20, 30, 40, 50, 100, 200, 250]
+import glob
+from control_summary import load_control_summary, control_counts
+
+SAMPLE_DENSITIES = [2, 3, 4, 5, 10, 20, 30, 40, 50, 100, 200, 250]
+
+def kde_tail_probability(controls_bimodal, unknown_bimodal, columns=None):
+    # P(X >= unknown) under the Gaussian KDE (Scott's rule, as scipy's gaussian_kde) of the
+    # bimodal counts of the control rivers, for every sample density at once.
+    # controls_bimodal: array of shape (n_controls, n_densities)
+    # unknown_bimodal:  array of shape (..., n_densities), or (n,) with columns
+    # columns:          for each unknown count, the column of the control counts it is tested against
+    # Returns an array of the shape of unknown_bimodal.
+    controls_bimodal = np.asarray(controls_bimodal, dtype=float)
+    n_controls = controls_bimodal.shape[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        h = controls_bimodal.std(axis=0, ddof=1) * n_controls ** (-1 / 5)
+    if columns is not None:
+        controls_bimodal, h = controls_bimodal[:, columns], h[columns]
+    if np.any(~(h > 0)):
+        raise np.linalg.LinAlgError("The control counts of a sample density have no spread; "
+                                    "the KDE of the controls is singular.")
+    z = (np.asarray(unknown_bimodal, dtype=float)[..., None, :] - controls_bimodal) / h
+    return 1 - ndtr(z).mean(axis=-2)
+
+def read_unknown(unknown_path, bw=None):
+    # Bimodality results of an unknown. Results of several bandwidths (with a bandwidth column,
+    # see results_table) must not be summed, so they are restricted to bw, which is required then.
+    unknown = pd.read_csv(unknown_path)
+    if 'bandwidth' not in unknown.columns:
+        return unknown
+    bandwidths = ", ".join(f"{b:g}" for b in sorted(unknown['bandwidth'].unique()))
+    if bw is None:
+        if unknown['bandwidth'].nunique() > 1:
+            raise ValueError(f"{unknown_path} holds the results of several bandwidths ({bandwidths}); "
+                             f"choose one of them.")
+        return unknown
+    unknown = unknown[unknown['bandwidth'] == bw]
+    if unknown.empty:
+        raise ValueError(f"{unknown_path} has no results for bandwidth {bw:g} (only {bandwidths}).")
+    return unknown
+
+def bimodality_significance(unknown_path, controls_path, n_meanders, bw=None):
+    # The controls are read from their compiled summary (see control_summary.py), and the
+    # null distributions of all sample densities are evaluated at once.
+    # bw: bandwidth of the results to test, for results of several bandwidths (see read_unknown)
+    sample_densities_to_save = SAMPLE_DENSITIES
     
     if n_meanders==0:
-        unknown = pd.read_csv(unknown_path)
-        controls = pd.read_csv(controls_path)
-
-        n_controls = controls['name'].nunique()
-        names_controls = controls['name'].unique()
+        unknown = read_unknown(unknown_path, bw)
+        summary = load_control_summary(controls_path)
 
-        p_values = []
         dir_path = os.path.dirname(unknown_path)
         file_name = os.path.splitext(os.path.basename(unknown_path))[0]
         file_stem = file_name.replace("_bimodality_results.csv", "")
 
         unknown_g = unknown.groupby('samples')['bimodal'].sum().reset_index() # in %
 
-        samples = pd.Series(list(set(unknown_g['samples']).intersection(controls['samples'])))
-        
-        for d in samples:
-            unknown_d_bimodal = unknown_g[unknown_g['samples']==d]['bimodal'].iloc[0]
-            controls_d = controls[controls['samples']==d]
-            controls_d_bimodal = []
-            for name in names_controls:
-                num_bimodal = controls_d[controls_d['name']==name]['bimodal'].sum()
-                controls_d_bimodal.append(num_bimodal)
-                
-            
-            kde = gaussian_kde(controls_d_bimodal, bw_method='scott')
-            xs = np.linspace(0,100,num=1000)
-
-            p_value_kde = (1 - kde.integrate_box_1d(-np.inf, unknown_d_bimodal))    
-            p_values.append([d, p_value_kde])
+        samples = pd.Series(list(set(unknown_g['samples']).intersection(summary['cohort_sizes'])), dtype=int)
+
+        # Number of bimodal replicates per control river (rows) and sample count (columns)
+        unknown_d_bimodal = unknown_g.set_index('samples')['bimodal'].loc[samples].to_numpy()
+        controls_d_bimodal = control_counts(summary, [summary['cohort_sizes'] == s for s in samples])
+
+        p_value_kde = kde_tail_probability(controls_d_bimodal, unknown_d_bimodal)
+        p_values = list(zip(samples, p_value_kde))
 
         df = pd.DataFrame(p_values, columns=['samples', 'p-value'])
         df.to_csv(os.path.join(dir_path, file_stem+'_p_values.csv'))
         
 
     else:
-        unknown = pd.read_csv(unknown_path)
-        controls = pd.read_csv(controls_path)
+        unknown = read_unknown(unknown_path, bw)
+        summary = load_control_summary(controls_path)
 
-        n_controls = controls['name'].nunique()
-        names_controls = controls['name'].unique()
+        names_controls = summary['names']
 
         if len(names_controls) <= 1:
             raise ValueError("Control data set must contain more than 1 river.")
 
-        p_values = []
         dir_path = os.path.dirname(unknown_path)
         file_name = os.path.basename(unknown_path)
         file_stem = file_name.replace("_bimodality_results.csv", "")
@@ -63,26 +89,85 @@ def bimodality_significance(unknown_path, controls_path, n_meanders):
 
         unknown_g = unknown.groupby('sample density')['bimodal'].sum().reset_index() # in %
 
-        controls['sample density'] = controls['samples']/n_meanders
+        controls_sample_density = summary['cohort_sizes']/n_meanders
         max_sample_density = unknown['sample density'].max()
 
         sample_densities_trunc= [d for d in sample_densities_to_save if d <= max_sample_density]
-        
-        for d in sample_densities_trunc:
-            unknown_d_bimodal = unknown_g[unknown_g['sample density']==d]['bimodal'].iloc[0]
-            controls_d = controls[controls['sample density']==d]
-            controls_d_bimodal = []
-            for name in names_controls:
-                num_bimodal = controls_d[controls_d['name']==name]['bimodal'].sum()
-                controls_d_bimodal.append(num_bimodal)
-
-            kde = gaussian_kde(controls_d_bimodal, bw_method='scott')
-            xs = np.linspace(0,100,num=1000)
-            
-            p_value_kde = (1 - kde.integrate_box_1d(-np.inf, unknown_d_bimodal))
-            p_values.append([d, num_bimodal, unknown_d_bimodal, p_value_kde])
+
+        # Number of bimodal replicates per control river (rows) and sample density (columns)
+        unknown_d_bimodal = np.array([unknown_g[unknown_g['sample density']==d]['bimodal'].iloc[0]
+                                      for d in sample_densities_trunc])
+        controls_d_bimodal = control_counts(summary, [controls_sample_density == d for d in sample_densities_trunc])
+
+        p_value_kde = kde_tail_probability(controls_d_bimodal, unknown_d_bimodal)
+        p_values = list(zip(sample_densities_trunc, controls_d_bimodal.mean(axis=0), unknown_d_bimodal, p_value_kde))
 
         df = pd.DataFrame(p_values, columns=['sample density', 'average bimodality rate controls',
                                              'bimodality rate unknown', 'p-value'])
         df.to_csv(os.path.join(dir_path, file_stem+f"_p_values.csv"))
-  
+
+def find_unknowns(unknowns):
+    # Paths of the unknowns given as a glob pattern, a path, or a list of both
+    if isinstance(unknowns, str):
+        unknowns = [unknowns]
+    paths = []
+    for unknown in unknowns:
+        paths.extend(sorted(glob.glob(unknown, recursive=True)) if glob.has_magic(unknown) else [unknown])
+    return paths
+
+def bimodality_significance_batch(unknowns, controls_path, n_meanders=0, output_path=None, bw=None):
+    # Tests many unknowns ('*_bimodality_results.csv' files, see find_unknowns) against one control set.
+    # n_meanders: number of meanders, a list of them (every unknown is tested with each), or a dictionary
+    #             from the file stem of an unknown to its number(s) of meanders. With 0 the unknown is
+    #             tested per sample count (the 'sample density' column holds the sample count).
+    # bw:         bandwidth of the results to test, for results of several bandwidths (see read_unknown)
+    # The null distribution of every sample density is set up once, and the tail probabilities of all
+    # unknowns are evaluated together. Sample densities an unknown does not have are skipped, and
+    # the p-value is NaN where the control counts have no spread.
+    # Returns the combined table of all unknowns, also written to output_path if given.
+    summary = load_control_summary(controls_path)
+    if len(summary['names']) <= 1:
+        raise ValueError("Control data set must contain more than 1 river.")
+    cohort_sizes = summary['cohort_sizes']
+
+    # One row per unknown, number of meanders and sample density. columns maps the cohort sizes
+    # of the controls that make up a sample density to the column of its control counts.
+    rows, columns = [], {}
+    for path in find_unknowns(unknowns):
+        file_stem = os.path.basename(path).replace("_bimodality_results.csv", "")
+        meanders = n_meanders.get(file_stem, 0) if isinstance(n_meanders, dict) else n_meanders
+        unknown_g = read_unknown(path, bw).groupby('samples')['bimodal'].sum()
+
+        for m in np.atleast_1d(meanders):
+            if m == 0:
+                unknown_d = unknown_g
+                densities = sorted(set(unknown_g.index).intersection(cohort_sizes))
+                controls_sample_density = cohort_sizes
+            else:
+                unknown_d = unknown_g.groupby(unknown_g.index / m).sum()
+                densities = [d for d in SAMPLE_DENSITIES if d in unknown_d.index]
+                controls_sample_density = cohort_sizes / m
+
+            for d in densities:
+                key = tuple(np.flatnonzero(controls_sample_density == d))
+                rows.append((file_stem, m, d, unknown_d.loc[d], columns.setdefault(key, len(columns))))
+
+    df = pd.DataFrame(rows, columns=['unknown', 'n_meanders', 'sample density',
+                                     'bimodality rate unknown', 'column'])
+
+    # Number of bimodal replicates per control river (rows) and distinct sample density (columns)
+    all_sizes = np.arange(len(summary['cohort_sizes']))
+    controls_bimodal = control_counts(summary, [np.isin(all_sizes, key) for key in columns])
+
+    column = df.pop('column').to_numpy(dtype=int)
+    valid = (controls_bimodal.std(axis=0, ddof=1) > 0)[column]
+    p_value_kde = np.full(len(df), np.nan)
+    p_value_kde[valid] = kde_tail_probability(controls_bimodal, df['bimodality rate unknown'].to_numpy()[valid],
+                                              column[valid])
+
+    df.insert(3, 'average bimodality rate controls', controls_bimodal.mean(axis=0)[column])
+    df['p-value'] = p_value_kde
+
+    if output_path is not None:
+        df.to_csv(output_path)
+    return df
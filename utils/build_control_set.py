@@ -0,0 +1,122 @@
+import os
+import json
+import random
+import hashlib
+import multiprocessing as mp
+from replicate_bimodality import replicate_bimodality
+
+# The control set builder keeps a manifest in its output directory that records, for every control
+# river, the hash of its Points file and the parameters its results were computed with. Rivers whose
+# inputs did not change since the last build are not recomputed, and an interrupted build resumes
+# with the rivers that were not finished yet.
+MANIFEST_FILE = 'control_manifest.json'
+RESULTS_SUFFIX = '_bimodality_results.csv'
+
+def find_control_points(input_dir):
+    # Points files of the control rivers by name; a legacy .csv file is used unless there is
+    # a .npz file of the same name
+    points_files = {}
+    for f in sorted(os.listdir(input_dir)):
+        stem, ext = os.path.splitext(f)
+        if ext == '.npz' or (ext == '.csv' and not os.path.exists(os.path.join(input_dir, stem + '.npz'))):
+            points_files[stem] = os.path.join(input_dir, f)
+    return points_files
+
+def result_path(output_dir, name):
+    return os.path.join(output_dir, name, f"{name}{RESULTS_SUFFIX}")
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def read_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def write_manifest(output_dir, manifest):
+    # Written to a temporary file first, so an interrupted build never leaves a broken manifest
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def control_river_worker(args):
+    # Draws the replicates of one control river and tests them, see replicate_bimodality
+    # Every river gets its own seed, so workers forked from the same process draw different replicates
+    name, points_path, n_replicates, bw, backend, result_file, seed = args
+    os.makedirs(os.path.dirname(result_file), exist_ok=True)
+    replicate_bimodality([points_path, n_replicates, bw, result_file], backend=backend, seed=seed)
+    return name
+
+def merge_results(result_files, controls_path):
+    # Writes the control set by appending the results of every river, one file after the other,
+    # keeping the header of the first
+    with open(controls_path + '.tmp', 'w') as out:
+        header = None
+        for result_file in result_files:
+            with open(result_file) as f:
+                first = f.readline()
+                if header is None:
+                    header = first
+                    out.write(header)
+                for line in f:
+                    out.write(line)
+    os.replace(controls_path + '.tmp', controls_path)
+
+def build_control_set(input_dir, output_dir, controls_path, bw, n_replicates=100, backend='sklearn', num_workers=None,
+                      seed=None):
+    # Applies the bimodality test to the replicates of every control river in input_dir (one Points file per river)
+    # and merges the results into the control set controls_path. The results of every river are saved in
+    # output_dir/<river>/<river>_bimodality_results.csv. Only rivers that are new, whose Points file changed,
+    # that were built with other parameters or whose results are missing are recomputed; the rivers are
+    # processed in a pool of num_workers processes (None for all CPUs).
+    # seed: seed of the replicates of all rivers; a build with the same seed gives the same control set.
+    #       Without a seed they are drawn from the random module.
+    # Returns the names of the rivers that were (re)built and of those that were up to date.
+    os.makedirs(output_dir, exist_ok=True)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    points_files = find_control_points(input_dir)
+    params = {'bw': bw, 'n_replicates': n_replicates, 'backend': backend, 'seed': seed}
+    manifest = read_manifest(output_dir)
+    manifest = {name: entry for name, entry in manifest.items() if name in points_files}
+
+    # The seeds of all rivers are drawn from seed (or the random module) in the order of the rivers;
+    # the seed of every built river is recorded in the manifest
+    rng = random if seed is None else random.Random(seed)
+    tasks, up_to_date, pending = [], [], {}
+    for name, points_path in points_files.items():
+        river_seed = rng.getrandbits(64)
+        entry = {'hash': file_hash(points_path), 'params': params}
+        recorded = manifest.get(name, {})
+        if ({key: recorded.get(key) for key in entry} == entry and
+                os.path.exists(result_path(output_dir, name))):
+            up_to_date.append(name)
+        else:
+            manifest.pop(name, None)
+            pending[name] = dict(entry, seed=river_seed)
+            tasks.append((name, points_path, n_replicates, bw, backend, result_path(output_dir, name), river_seed))
+    write_manifest(output_dir, manifest)
+
+    # Every finished river is recorded right away, so that an interrupted build can be resumed
+    def done(name):
+        manifest[name] = pending[name]
+        write_manifest(output_dir, manifest)
+
+    if num_workers > 1 and len(tasks) > 1:
+        with mp.Pool(min(num_workers, len(tasks))) as pool:
+            for name in pool.imap_unordered(control_river_worker, tasks):
+                done(name)
+    else:
+        for task in tasks:
+            done(control_river_worker(task))
+
+    merge_results([result_path(output_dir, name) for name in points_files], controls_path)
+    return {'built': [task[0] for task in tasks], 'up_to_date': up_to_date}
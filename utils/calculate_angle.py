@@ -9,3 +9,12 @@ def calculate_angle(slope):
     dy = slope 
     angle = np.degrees(-np.arcsin(dy / np.sqrt(dx**2 + dy**2) )) # the minus sign makes result agree with angle definition
     return angle
+
+def calculate_angle_batch(slopes):
+    # Array version of calculate_angle
+    slopes = np.asarray(slopes, dtype=float)
+    with np.errstate(invalid='ignore', over='ignore'):
+        angles = np.degrees(-np.arcsin(slopes / np.sqrt(1 + slopes**2)))
+    angles = np.where(np.abs(slopes) <= 1e-6, 0.0, angles)
+    angles = np.where(slopes == np.inf, 90.0, angles)
+    return angles
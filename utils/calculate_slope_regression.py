@@ -1,9 +1,8 @@
 import numpy as np
-from sklearn.linear_model import LinearRegression
-from scipy.optimize import curve_fit
-from scipy import stats
 
 def calculate_slope_regression(neighbors):
+    from sklearn.linear_model import LinearRegression  # only needed here, imported on first use
+
     if len(neighbors) < 2:
         return None  # At least two points are needed to calculate a slope
 
@@ -23,3 +22,31 @@ def calculate_slope_regression(neighbors):
     slope = model.coef_[0]
     
     return slope
+
+def calculate_slope_regression_batch(neighbors, counts):
+    # Closed-form least squares slopes for many neighbor sets at once.
+    # neighbors: array of shape (K, M, 2), each row padded to M points
+    # counts:    number of valid points in each row
+    # Returns an array of K slopes; rows with fewer than two points get NaN.
+    neighbors = np.asarray(neighbors, dtype=float)
+    counts = np.asarray(counts)
+    valid = np.arange(neighbors.shape[1])[None, :] < counts[:, None]
+    n = np.maximum(counts, 1)
+
+    x = np.where(valid, neighbors[:, :, 0], 0.0)
+    y = np.where(valid, neighbors[:, :, 1], 0.0)
+
+    # Deviations from the mean (zero for padded entries)
+    dx = np.where(valid, x - (x.sum(axis=1) / n)[:, None], 0.0)
+    dy = np.where(valid, y - (y.sum(axis=1) / n)[:, None], 0.0)
+
+    # Same special cases as calculate_slope_regression
+    horizontal = np.all(np.where(valid, neighbors[:, :, 1] == neighbors[:, :1, 1], True), axis=1)
+    vertical = np.all(np.where(valid, neighbors[:, :, 0] == neighbors[:, :1, 0], True), axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = (dx * dy).sum(axis=1) / (dx * dx).sum(axis=1)
+    slopes = np.where(vertical, np.inf, slopes)
+    slopes = np.where(horizontal, 0.0, slopes)
+    slopes[counts < 2] = np.nan
+    return slopes
@@ -1,11 +1,82 @@
 import numpy as np
 from scipy.signal import find_peaks
-from sklearn.neighbors import KernelDensity
-import matplotlib.pyplot as plt
-from rose_diagram import *
 
-def compute_kde(angles, x_vals, bw):
+def kernel_basis(angles, x_vals, bw, dtype=np.float32):
+    # Gaussian kernel of every angle evaluated on the grid, wrapped around the
+    # 180° periodic domain of the angles. Returns an array of shape (len(angles), len(x_vals));
+    # the KDE of any subset of the angles is the mean of its rows.
+    angles = np.asarray(angles, dtype=float)
+    n_wraps = 1 + int(np.ceil(4 * bw / 180))
+    basis = np.zeros((len(angles), len(x_vals)), dtype=dtype)
+    for k in range(-n_wraps, n_wraps + 1):
+        z = (x_vals[None, :] - angles[:, None] + 180 * k) / bw
+        basis += np.exp(-0.5 * z**2) / (bw * np.sqrt(2 * np.pi))
+    return basis
+
+def wrapped_kernel(n_grid, bw):
+    # Gaussian kernel wrapped around the 180° periodic domain, on a periodic grid of n_grid points
+    # (offsets 0, 1, ..., n_grid - 1 grid steps)
+    offsets = np.arange(n_grid) * 180 / n_grid
+    n_wraps = 1 + int(np.ceil(4 * bw / 180))
+    kernel = np.zeros(n_grid)
+    for k in range(-n_wraps, n_wraps + 1):
+        kernel += np.exp(-0.5 * ((offsets + 180 * k) / bw)**2) / (bw * np.sqrt(2 * np.pi))
+    return kernel
+
+def binned_spectrum(angles, offsets, x_vals):
+    # Linearly bins the angles of every cohort onto the periodic grid and returns the Fourier
+    # transform of the counts (one row per cohort). It does not depend on the bandwidth.
+    n_grid = len(x_vals) - 1
+    step = 180 / n_grid
+    sizes = np.diff(offsets)
+    cohort = np.repeat(np.arange(len(sizes)), sizes)
+    positions = (np.asarray(angles, dtype=float) - x_vals[0]) / step
+    left = np.floor(positions)
+    weight = positions - left
+    left = left.astype(int) % n_grid
+    total = len(sizes) * n_grid
+    counts = (np.bincount(cohort * n_grid + left, 1 - weight, minlength=total) +
+              np.bincount(cohort * n_grid + (left + 1) % n_grid, weight, minlength=total)).reshape(len(sizes), n_grid)
+    return np.fft.rfft(counts, axis=1)
+
+def smooth_spectrum(spectrum, sizes, x_vals, bw):
+    # Convolves binned counts (see binned_spectrum) with the wrapped Gaussian of bandwidth bw
+    n_grid = len(x_vals) - 1
+    density = np.fft.irfft(spectrum * np.fft.rfft(wrapped_kernel(n_grid, bw)), n=n_grid, axis=1)
+    density /= sizes[:, None]
+    # FFT round-off would create tiny spurious peaks where there are no angles
+    density[density < 1e-12 * density.max(axis=1, keepdims=True)] = 0
+    return np.hstack([density, density[:, :1]])
+
+def fft_kde_batch(angles, offsets, x_vals, bw):
+    # fft_kde of many cohorts at once. The angles of cohort i are angles[offsets[i]:offsets[i + 1]].
+    # Returns an array of shape (number of cohorts, len(x_vals)).
+    return smooth_spectrum(binned_spectrum(angles, offsets, x_vals), np.diff(offsets), x_vals, bw)
+
+def fft_kde(angles, x_vals, bw):
+    # Binned circular KDE: the angles are linearly binned onto the periodic grid and convolved with
+    # a wrapped Gaussian via FFT. The cost does not depend on the number of angles.
+    # x_vals must span the period evenly, with both ends included (like np.linspace(-90, 90, 1000)).
+    return fft_kde_batch(angles, np.array([0, len(angles)]), x_vals, bw)[0]
+
+# Backends whose KDE is periodic over the 180° domain of the angles
+PERIODIC_BACKENDS = ('wrapped', 'fft')
+
+def shift_kde(kde_vals, x_vals, shift):
+    # Evaluates a periodic KDE at x_vals + shift by linear interpolation on its grid
+    # (the last grid point is the first one, one period later).
+    return np.interp(x_vals + shift, x_vals[:-1], kde_vals[:-1], period=180)
+
+def compute_kde(angles, x_vals, bw, backend='sklearn'):
     # Compute KDE with a specified bandwidth.
+    # backend: 'sklearn' (Gaussian kernels on the line),
+    #          'wrapped' (Gaussian kernels wrapped around the 180° periodic domain, float32) or
+    #          'fft' (binned wrapped KDE via FFT, see fft_kde)
+    if backend == 'wrapped':
+        return kernel_basis(angles, x_vals, bw).mean(axis=0)
+    if backend == 'fft':
+        return fft_kde(angles, x_vals, bw)
+    from sklearn.neighbors import KernelDensity  # the other backends do not need scikit-learn
     kde = KernelDensity(kernel='gaussian', bandwidth=bw).fit(angles[:, None])
     return np.exp(kde.score_samples(x_vals[:, None]))
 
@@ -32,22 +103,33 @@ def get_closest_minimum(data, peak_idx, minima):
     return data[minima[np.argmin(np.abs(minima - peak_idx))]]
 
 
-def check_bimodality(angles, bw=8, reorient=True):
+def check_bimodality(angles, bw=8, reorient=True, backend='sklearn', kde_vals=None):
     # Checks for bimodality based on peak heights.
     # angles:   array-like object containing the flow direction angles. 
     # bw:       bandwidth for KDE analysis. The default value bw=8 has been chosen to produce
-    #           maximum agreement with manual bimodality classifications. 
+    #           maximum agreement with manual bimodality classifications. For a list of bandwidths,
+    #           a list with one (bimodal, similar_height, height_check) tuple per bandwidth is returned.
     # reorient: Boolean that determines whether the histogram will be reoriented before the 
     #           bimodality test. If True, all angles will be recalculated with respect to the 
     #           point halfway between the two tallest peaks. Using reorient=True is recommended
     #           because the default angles (calculated with respect to 0° N) are arbitrary, wherease
     #           the reoriented angles may better reflect the data distribution and make it easier 
     #           to detect bimodality.
+    # backend:  KDE backend, see compute_kde.
+    # kde_vals: KDE of the angles on the grid np.linspace(-90, 90, 1000), if it has already been
+    #           computed (e.g. from a kernel basis, see bimodality_of_replicates.py).
+
+    if np.ndim(bw) > 0:
+        # One result per bandwidth
+        bimodal, similar_height, height_check = check_bimodality_batch(angles, [0, len(angles)], bw, reorient, backend)
+        return [(b[0], None if np.isnan(s[0]) else bool(s[0]), None if np.isnan(h[0]) else bool(h[0]))
+                for b, s, h in zip(bimodal, similar_height, height_check)]
 
     bins = np.arange(-90, 91, 10)
     x_vals = np.linspace(-90, 90, 1000)
     angles = (angles + 90) % 180 - 90
-    kde_vals = compute_kde(angles, x_vals, bw)
+    if kde_vals is None:
+        kde_vals = compute_kde(angles, x_vals, bw, backend)
     peaks, peak_heights = analyze_peaks(kde_vals, x_vals)
     kde_vals_reor = np.zeros_like(kde_vals)
     peaks_reor, peak_heights_reor = np.zeros_like(peaks), np.zeros_like(peak_heights)
@@ -104,8 +186,12 @@ def check_bimodality(angles, bw=8, reorient=True):
             # Reorient the angles relative to the midpoint, wrapping them to [-90, +90]
             reoriented_angles = (angles - midpoint + 90) % 180 - 90
 
-            # Recompute the KDE on reoriented angles
-            kde_vals_reor = compute_kde(reoriented_angles, x_vals, bw)
+            # Recompute the KDE on reoriented angles. A periodic KDE of the reoriented
+            # angles is the original KDE shifted by the midpoint, so it does not need to be refitted.
+            if backend in PERIODIC_BACKENDS:
+                kde_vals_reor = shift_kde(kde_vals, x_vals, midpoint)
+            else:
+                kde_vals_reor = compute_kde(reoriented_angles, x_vals, bw, backend)
 
             # Recompute peaks and peak heights for the reoriented KDE
             peaks_reor, peak_heights_reor = analyze_peaks(kde_vals_reor, x_vals)          
@@ -141,3 +227,104 @@ def check_bimodality(angles, bw=8, reorient=True):
                     bimodal = similar_height and height_check
 
     return bimodal, similar_height, height_check
+
+def compute_kde_batch(angles, offsets, x_vals, bw, backend='sklearn'):
+    # KDEs of many cohorts at once, one row per cohort (see check_bimodality_batch)
+    if backend == 'fft':
+        return fft_kde_batch(angles, offsets, x_vals, bw)
+    return np.vstack([compute_kde(angles[offsets[i]:offsets[i + 1]], x_vals, bw, backend)
+                      for i in range(len(offsets) - 1)])
+
+def shift_kde_batch(kde_vals, x_vals, shifts):
+    # shift_kde of every row of kde_vals by its own shift
+    n_grid = len(x_vals) - 1
+    step = 180 / n_grid
+    positions = ((x_vals[None, :] + shifts[:, None] - x_vals[0]) / step) % n_grid
+    left = np.floor(positions).astype(int) % n_grid
+    weight = positions - np.floor(positions)
+    periodic = kde_vals[:, :-1]
+    return ((1 - weight) * np.take_along_axis(periodic, left, axis=1) +
+            weight * np.take_along_axis(periodic, (left + 1) % n_grid, axis=1))
+
+def peak_mask(kde_vals):
+    # Marks the peaks of every row, like find_peaks. Rows with flat stretches are
+    # handed to find_peaks, which places plateau peaks in their middle.
+    is_peak = np.zeros(kde_vals.shape, dtype=bool)
+    is_peak[:, 1:-1] = (kde_vals[:, 1:-1] > kde_vals[:, :-2]) & (kde_vals[:, 1:-1] > kde_vals[:, 2:])
+    for i in np.flatnonzero(np.any(np.diff(kde_vals, axis=1) == 0, axis=1)):
+        is_peak[i] = False
+        is_peak[i, find_peaks(kde_vals[i])[0]] = True
+    return is_peak
+
+def tallest_peaks(kde_vals):
+    # Returns the number of peaks of every row and the positions of its three tallest peaks
+    # (in the order of check_bimodality; only the first min(3, number of peaks) are meaningful)
+    is_peak = peak_mask(kde_vals)
+    heights = np.where(is_peak, kde_vals, -np.inf)
+    order = np.argsort(heights, axis=1, kind='stable')[:, ::-1][:, :3]
+    return is_peak.sum(axis=1), order
+
+def height_test(kde_vals, n_peaks, order):
+    # Similar height and height checks of check_bimodality for every row.
+    # Returns bimodal (bool) and similar_height, height_check (float, NaN where not applied).
+    rows = np.arange(len(kde_vals))
+    h1, h2, h3 = (kde_vals[rows, order[:, i]] for i in range(3))
+
+    similar_height = np.abs(h1 - h2) <= 0.5 * h1 + 1e-5 * np.abs(h2)
+    height_check = np.minimum(h1, h2) >= 2 * h3
+
+    bimodal = (n_peaks >= 2) & similar_height & ((n_peaks == 2) | height_check)
+    similar_height = np.where(n_peaks >= 2, similar_height, np.nan)
+    height_check = np.where(n_peaks > 2, height_check, np.nan)
+    return bimodal, similar_height, height_check
+
+def bimodality_of_kdes(angles, offsets, kde_vals, x_vals, bw, reorient, backend):
+    # Peak tests of check_bimodality_batch for the KDEs of wrapped angles
+    n_peaks, order = tallest_peaks(kde_vals)
+    if not reorient:
+        return height_test(kde_vals, n_peaks, order)
+
+    # Reorient the cohorts with at least 2 peaks with respect to the midpoint of their two tallest peaks
+    reor = np.flatnonzero(n_peaks >= 2)
+    midpoints = x_vals[order[reor, :2]].mean(axis=1)
+    if backend in PERIODIC_BACKENDS:
+        kde_vals_reor = shift_kde_batch(kde_vals[reor], x_vals, midpoints)
+    else:
+        kde_vals_reor = np.zeros((len(reor), len(x_vals)))
+        for row, (i, m) in enumerate(zip(reor, midpoints)):
+            kde_vals_reor[row] = compute_kde((angles[offsets[i]:offsets[i + 1]] - m + 90) % 180 - 90, x_vals, bw, backend)
+
+    bimodal = np.zeros(len(kde_vals), dtype=bool)
+    similar_height = np.full(len(kde_vals), np.nan)
+    height_check = np.full(len(kde_vals), np.nan)
+    n_peaks_reor, order_reor = tallest_peaks(kde_vals_reor)
+    bimodal[reor], similar_height[reor], height_check[reor] = height_test(kde_vals_reor, n_peaks_reor, order_reor)
+    return bimodal, similar_height, height_check
+
+def check_bimodality_batch(angles, offsets, bw=8, reorient=True, backend='sklearn', kde_vals=None):
+    # Batch version of check_bimodality for many cohorts at once.
+    # angles:   angles of all cohorts, one cohort after the other
+    # offsets:  the angles of cohort i are angles[offsets[i]:offsets[i + 1]]
+    # bw:       bandwidth, or a list of bandwidths. The angles are wrapped (and binned) only once
+    #           for all bandwidths.
+    # kde_vals: KDEs of the cohorts (one row each), if they have already been computed (single bandwidth)
+    # Returns arrays bimodal (bool), similar_height and height_check (float, NaN where check_bimodality
+    # returns None). For a list of bandwidths, the arrays have one row per bandwidth.
+    x_vals = np.linspace(-90, 90, 1000)
+    angles = (np.asarray(angles, dtype=float) + 90) % 180 - 90
+    offsets = np.asarray(offsets)
+
+    if np.ndim(bw) == 0:
+        if kde_vals is None:
+            kde_vals = compute_kde_batch(angles, offsets, x_vals, bw, backend)
+        return bimodality_of_kdes(angles, offsets, kde_vals, x_vals, bw, reorient, backend)
+
+    spectrum = binned_spectrum(angles, offsets, x_vals) if backend == 'fft' else None
+    results = []
+    for b in bw:
+        if spectrum is not None:
+            kde_vals_b = smooth_spectrum(spectrum, np.diff(offsets), x_vals, b)
+        else:
+            kde_vals_b = compute_kde_batch(angles, offsets, x_vals, b, backend)
+        results.append(bimodality_of_kdes(angles, offsets, kde_vals_b, x_vals, b, reorient, backend))
+    return tuple(np.array(r) for r in zip(*results))
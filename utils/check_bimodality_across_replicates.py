@@ -1,50 +1,124 @@
 import numpy as np
 import pandas as pd
 import os
-import re
+import multiprocessing as mp
 from utils.check_bimodality import *
+from replicate_store import find_replicate_store, read_replicate_store, iter_cohorts
+from bimodality_of_replicates import bimodality_of_replicates, results_table
 
-def check_bimodality_across_replicates(args):
-    data_dir, bw, save_path = args
-    base_name = os.path.basename(data_dir)
+def bimodality_of_cohorts(name, cohorts, bw, backend='sklearn'):
+    # Applies the bimodality test to (replicate, cohort size, cohort) tuples, see replicate_store.iter_cohorts.
+    # All cohorts are tested at once with check_bimodality_batch.
+    # bw: bandwidth, or a list of bandwidths (see results_table)
+    # Returns the results table.
+    replicates, sample_counts, angles = [], [], []
+    for replicate_index, sample_count, data in cohorts:
+        replicates.append(replicate_index)
+        sample_counts.append(sample_count)
+        angles.append(data[:, 3])
+
+    if not angles:
+        return results_table(name, [], [], np.zeros((np.size(bw), 0)) if np.ndim(bw) else [], bw)
+
+    offsets = np.concatenate([[0], np.cumsum([len(a) for a in angles])]).astype(int)
+    angles = np.concatenate(angles)
+    bimodal = check_bimodality_batch(angles, offsets, bw, True, backend)[0]
+
+    return results_table(name, sample_counts, replicates, bimodal, bw)
+
+def store_shard_worker(args):
+    # Tests the cohorts of some replicates of a replicate store (a dictionary of its arrays),
+    # the first of which is replicate first_replicate
+    name, store, first_replicate, bw, backend = args
+    if backend == 'wrapped':
+        results_df = bimodality_of_replicates(name, store, bw)
+    else:
+        results_df = bimodality_of_cohorts(name, iter_cohorts(store), bw, backend)
+    results_df['replicate'] += first_replicate - 1
+    return results_df
 
-    all_replicates = os.listdir(data_dir)
+def replicate_dirs_worker(args):
+    # Tests the cohorts saved as CSV files in some replicate directories
+    data_dir, name, replicate_dirs, bw, backend = args
+    cohorts = []
+    for replicate_dir in replicate_dirs:
+        replicate_index = replicate_dir.split("_")[1]
 
-    results = []
-    
-    # Iterate through replicate directories (1 to 100)
-    for replicate_dir in all_replicates:
-        if replicate_dir.startswith("replicate_"):
+        # Read CSV files from the replicate directory, in the order of their sample counts
+        file_names = [f for f in os.listdir(os.path.join(data_dir, replicate_dir)) if f.endswith('.csv')]
+        for file_name in sorted(file_names, key=lambda f: int(f.split('_')[-2])):
 
-            replicate_index = replicate_dir.split("_")[1]
+            # Read the CSV file
+            file_path = os.path.join(data_dir, replicate_dir, file_name)
 
-            # Read CSV files from the replicate directory
-            for file_name in os.listdir(os.path.join(data_dir, replicate_dir)):
-                if file_name.endswith('.csv'):
+            # Extract sample count from file name
+            sample_count = int(file_name.split('_')[-2])
 
-                    # Read the CSV file
-                    file_path = os.path.join(data_dir, replicate_dir, file_name)
+            data = pd.read_csv(file_path, header=None).values
+            cohorts.append((replicate_index, sample_count, data))
 
-                    # Extract sample count from file name
-                    sample_count = int(file_name.split('_')[-2])
+    return bimodality_of_cohorts(name, cohorts, bw, backend)
+
+def run_shards(worker, shards, num_workers, empty, bw=None):
+    # Runs the worker on every shard, in a process pool if num_workers > 1,
+    # and concatenates the results in the order of the shards (empty if there are no shards).
+    # For a list of bandwidths every table holds one block of rows per bandwidth (see results_table);
+    # the blocks of all shards are concatenated bandwidth by bandwidth, so that the rows are in the
+    # same order for any number of shards.
+    if num_workers > 1 and len(shards) > 1:
+        with mp.Pool(min(num_workers, len(shards))) as pool:
+            tables = pool.map(worker, shards)
+    else:
+        tables = [worker(shard) for shard in shards]
+    if not tables:
+        return empty
+    if np.ndim(bw) > 0:
+        tables = [table.iloc[i * len(table) // len(bw):(i + 1) * len(table) // len(bw)]
+                  for i in range(len(bw)) for table in tables]
+    return pd.concat(tables, ignore_index=True)
+
+def bimodality_of_store(name, store, bw, backend='sklearn', num_workers=1):
+    # Applies the bimodality test to all cohorts of a replicate store (see replicate_store.py),
+    # with the replicates split into num_workers contiguous shards.
+    keys = ['cohort_sizes', 'pixel', 'slope', 'angle']
+    shared = {key: np.asarray(store[key]) for key in keys}
+    indices = np.asarray(store['indices'])
+    shards = []
+    first_replicate = 1
+    for part in np.array_split(indices, num_workers):
+        if len(part) > 0:
+            shards.append((name, dict(shared, indices=part), first_replicate, bw, backend))
+        first_replicate += len(part)
+    return run_shards(store_shard_worker, shards, num_workers, bimodality_of_cohorts(name, [], bw), bw)
+
+def check_bimodality_across_replicates(args, backend='sklearn', num_workers=1):
+    # bw in args can be a list of bandwidths; all of them are evaluated in one pass and the
+    # results table gets a bandwidth column.
+    # backend:     KDE backend ('sklearn', 'wrapped' or 'fft'), see check_bimodality.compute_kde.
+    #              With 'wrapped', the KDEs of all cohorts in a replicate store are computed from one kernel basis.
+    # num_workers: number of worker processes the replicates are split across, None for all CPUs.
+    #              The results are the same for any number of workers.
+    data_dir, bw, save_path = args
+    base_name = os.path.basename(data_dir)
 
-                    data = pd.read_csv(file_path, header=None).values
-                    angles = data[:, 3]
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
 
-                    x_vals = np.linspace(-90, 90, 1000)
-                    kde_vals = compute_kde(angles, x_vals, bw)
-                    peaks, peak_heights = analyze_peaks(kde_vals, x_vals)
+    # Replicates saved in a replicate store (see replicate_store.py)
+    store_file = find_replicate_store(data_dir)
+    if store_file is not None:
+        with read_replicate_store(store_file) as store:
+            results_df = bimodality_of_store(base_name, store, bw, backend, num_workers)
+        results_df.to_csv(save_path)
+        return
 
-                    bimodal, similar_heights, height_check = check_bimodality(angles, bw, True)
+    # Replicates saved as CSV files, one directory per replicate (1 to 100)
+    all_replicates = sorted([d for d in os.listdir(data_dir) if d.startswith("replicate_")],
+                            key=lambda d: int(d.split("_")[1]))
 
-                    # Store results in a dictionary
-                    results.append({
-                        'name': base_name,
-                        'samples': sample_count,
-                        'bimodal': bimodal,
-                        'replicate': replicate_index,  # Include replicate index
-                        })
+    shards = [(data_dir, base_name, list(part), bw, backend)
+              for part in np.array_split(np.array(all_replicates, dtype=object), num_workers) if len(part) > 0]
 
     # Convert results to a DataFrame for easy manipulation
-    results_df = pd.DataFrame(results)
+    results_df = run_shards(replicate_dirs_worker, shards, num_workers, bimodality_of_cohorts(base_name, [], bw), bw)
     results_df.to_csv(save_path)
@@ -1,14 +1,10 @@
 import os
 import numpy as np
 import pandas as pd
-import matplotlib
-matplotlib.use("TkAgg")  # Ensure interactive backend for .exe
-import matplotlib.pyplot as plt
+import matplotlib.pyplot as plt  # interactive (TkAgg) backend, selected by run.py
 from matplotlib.widgets import Button
-from scipy.signal import find_peaks, peak_prominences
-from sklearn.neighbors import KernelDensity
 from rose_diagram import rose_diagram
-from datetime import datetime
+from sgr_corpus import load_sgr_corpus, write_sgr_corpus, corpus_path, entry_angles, source_stamp
 
 
 def classify_rosediagrams_manually(input_dir, output_path):
@@ -17,11 +13,11 @@ def classify_rosediagrams_manually(input_dir, output_path):
                              32, 40, 50, 60, 80, 90, 100, 120, 150, 160, 200,
                              240, 250, 300, 320, 400, 500, 600, 750, 800, 1000, 1250,
                              1600, 2000, 2500])
-    sample_files = {
-        f"{os.path.basename(root).removeprefix('sine_generated_river').lstrip('_')}_{file}": os.path.join(root, file)
-        for root, _, files in os.walk(input_dir) for file in files
-        if file.startswith('w') and file.endswith('.csv') and not file.endswith('samples.csv')
-    }
+    # Rivers of the packed SGR corpus (see sgr_corpus.py); the new cohorts replace the packed ones at the end
+    corpus = load_sgr_corpus(input_dir)
+    river_paths = [path for path, size in zip(corpus['paths'], corpus['cohort_size']) if size == 0]
+    entries = {path: np.array(entry_angles(corpus, i)) for i, path in enumerate(corpus['paths'])}
+    del corpus
 
     class BimodalitySelector:
         def __init__(self, file_name):
@@ -46,7 +42,8 @@ def classify_rosediagrams_manually(input_dir, output_path):
             bimodality_results.append([self.file_name, is_bimodal])
             plt.close(self.fig)
 
-    for file_path in sample_files.values():
+    for river_path in river_paths:
+        file_path = os.path.join(input_dir, river_path)
         file_name = os.path.basename(file_path)
         data = pd.read_csv(file_path)
         angles = data['average angle'].values
@@ -61,6 +58,7 @@ def classify_rosediagrams_manually(input_dir, output_path):
 
             output_file = f"{os.path.splitext(file_path)[0]}_{cohort_size}samples.csv"
             subset.to_csv(output_file, index=False)
+            entries[os.path.relpath(output_file, input_dir).replace(os.sep, '/')] = subset_angles
 
             fig = plt.figure(figsize=(12, 6))
             plt.subplots_adjust(bottom=0.22)
@@ -86,5 +84,8 @@ def classify_rosediagrams_manually(input_dir, output_path):
 
             BimodalitySelector(file_name_with_cohortsize)
 
+    # The cohort files were just written, so the corpus matches the current state of the directory
+    write_sgr_corpus(corpus_path(input_dir), list(entries), list(entries.values()), source_stamp(input_dir))
+
     results_df = pd.DataFrame(bimodality_results, columns=['File', 'Bimodal'])
     results_df.to_csv(output_path, index=False)
@@ -0,0 +1,76 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+# A control summary is the compiled form of a controls CSV file (the bimodality results of all
+# control rivers): the number of bimodal replicates of every control river and cohort size,
+# a (river x cohort size) count matrix. The river names and cohort sizes are stored once, in order
+# of first appearance in the CSV file. Summaries are small .npz files kept in the user's cache
+# (not next to the CSV files, which may be under version control) and recompiled whenever the
+# CSV file changes.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'river-processing', 'controls')
+SUMMARY_SUFFIX = '.summary.npz'
+
+def summary_path(controls_path, cache_dir=DEFAULT_CACHE_DIR):
+    # One summary per controls CSV file, named after the file and the hash of its absolute path
+    key = hashlib.sha256(os.path.abspath(controls_path).encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(controls_path))[0]
+    return os.path.join(cache_dir, f"{stem}_{key}{SUMMARY_SUFFIX}")
+
+def source_stamp(controls_path):
+    # Size and modification time of the controls CSV file, to detect a stale summary
+    stat = os.stat(controls_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def compile_control_summary(controls_path, output_path=None):
+    # Compiles the controls CSV file into a control summary and writes it to output_path
+    # (by default its place in the cache, see summary_path). Returns the summary.
+    controls = pd.read_csv(controls_path, usecols=['name', 'samples', 'bimodal'])
+    name_codes, names = pd.factorize(controls['name'])
+    size_codes, cohort_sizes = pd.factorize(controls['samples'])
+
+    counts = np.zeros((len(names), len(cohort_sizes)), dtype=np.int64)
+    np.add.at(counts, (name_codes, size_codes), controls['bimodal'].to_numpy().astype(np.int64))
+
+    summary = {
+        'names': np.asarray(names, dtype=str),
+        'cohort_sizes': np.asarray(cohort_sizes, dtype=np.int64),
+        'counts': counts,
+        'source': source_stamp(controls_path),
+    }
+    if output_path is None:
+        output_path = summary_path(controls_path)
+
+    # Written to a temporary file first, so that concurrent readers never see a partial summary.
+    # Without a writable cache the summary is only used for this run.
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **summary)
+        os.replace(tmp_path, output_path)
+    except OSError:
+        pass
+    return summary
+
+def load_control_summary(controls_path, cache_dir=DEFAULT_CACHE_DIR):
+    # Returns the control summary of a controls CSV file: the cached one if it is up to date,
+    # otherwise the summary is (re)compiled first
+    path = summary_path(controls_path, cache_dir)
+    if os.path.exists(path):
+        try:
+            with np.load(path) as data:
+                summary = {key: data[key] for key in data.files}
+        except (OSError, ValueError):
+            # Corrupt summary, recompile below
+            summary = {}
+        if np.array_equal(summary.get('source'), source_stamp(controls_path)):
+            return summary
+    return compile_control_summary(controls_path, path)
+
+def control_counts(summary, masks):
+    # Number of bimodal replicates of every control river (rows) summed over each group of cohort sizes
+    # (columns); masks: one boolean mask over summary['cohort_sizes'] per group
+    masks = np.asarray(masks, dtype=bool).reshape(-1, len(summary['cohort_sizes']))
+    return summary['counts'] @ masks.T
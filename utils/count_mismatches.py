@@ -1,20 +1,15 @@
 import os
 import pandas as pd
 import numpy as np
-from scipy.signal import find_peaks, peak_prominences
-from scipy.stats import gaussian_kde
-from sklearn.neighbors import KernelDensity
-from scipy.optimize import minimize
-import matplotlib.pyplot as plt
-from datetime import datetime
 from check_bimodality import *    
+from sgr_corpus import load_sgr_corpus, entry_angles
 
 
-def count_mismatches(calibration_folder, sgr_folder, bw):
-    # Count the number of mismatches between the bimodality calibration set
-    # and the results from applying the bimodality check to the 'samples.csv' files.
-
-    bimodality_data = {}
+def load_calibration_corpus(calibration_folder, sgr_folder):
+    # Loads the bimodality calibration set and the angles of all classified 'samples.csv' files once,
+    # from the packed SGR corpus (packed on first use).
+    # Returns a dictionary with the file names, the angles of all files (one after the other),
+    # their offsets and the expected bimodality results.
 
     # Step 1: Load all .csv files from the calibration folder
     calibration_files = [f for f in os.listdir(calibration_folder) if f.startswith('bimodality_calibration_set')
@@ -35,31 +30,35 @@ def count_mismatches(calibration_folder, sgr_folder, bw):
     average_df.columns = ['File', 'Average']
 
     average_df['Average'] = average_df['Average'] >= 0.5
-
-    mismatch_count = 0
-    # Walk through the SGR directory to find all 'samples.csv' files
-    for root, _, files in os.walk(sgr_folder):
-        for file in files:
-            if file.endswith('samples.csv'):
-                file_path = os.path.join(root, file)
-
-                # Apply the bimodality check to the file
-                data = pd.read_csv(file_path)
-                angles = data['average angle'].values
-
-                x_vals = np.linspace(-90, 90, 1000)
-                kde_vals = compute_kde(angles, x_vals, bw)
-                peaks, peak_heights = analyze_peaks(kde_vals, x_vals)
-
-                bimodal_result, similar_heights, height_check = check_bimodality(angles, bw, reorient=True)
-
-
-                # Check against the calibration set
-                if file in average_df['File'].values:
-                    
-                    expected_bimodal = average_df[average_df['File']==file]['Average'].values[0]
-                    # If the bimodality results don't match, count it as a mismatch
-                    if (bimodal_result != expected_bimodal):
-                        mismatch_count += 1
-                        
-    return mismatch_count
+    expected = dict(zip(average_df['File'], average_df['Average']))
+
+    # Step 2: Look up the classified 'samples.csv' files in the packed SGR corpus (see sgr_corpus.py)
+    sgr = load_sgr_corpus(sgr_folder)
+    file_names, angles, labels = [], [], []
+    for i, file in enumerate(sgr['files']):
+        if file.endswith('samples.csv') and file in expected:
+            file_names.append(file)
+            angles.append(entry_angles(sgr, i))
+            labels.append(expected[file])
+
+    return {
+        'files': file_names,
+        'angles': np.concatenate(angles) if angles else np.empty(0),
+        'offsets': np.concatenate([[0], np.cumsum([len(a) for a in angles])]).astype(int),
+        'expected': np.array(labels, dtype=bool),
+    }
+
+def corpus_mismatches(corpus, bw, backend='sklearn'):
+    # Number of mismatches between the calibration set and the bimodality check of a loaded corpus
+    # (see load_calibration_corpus). For a list of bandwidths, returns an array with one count per bandwidth.
+    if len(corpus['files']) == 0:
+        return np.zeros(np.shape(bw), dtype=int)
+    bimodal = check_bimodality_batch(corpus['angles'], corpus['offsets'], bw, reorient=True, backend=backend)[0]
+    return (bimodal != corpus['expected']).sum(axis=-1)
+
+def count_mismatches(calibration_folder, sgr_folder, bw, backend='sklearn'):
+    # Count the number of mismatches between the bimodality calibration set
+    # and the results from applying the bimodality check to the 'samples.csv' files.
+    # backend: KDE backend, see check_bimodality.compute_kde
+    corpus = load_calibration_corpus(calibration_folder, sgr_folder)
+    return int(corpus_mismatches(corpus, bw, backend))
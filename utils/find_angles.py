@@ -4,109 +4,133 @@ from utils.calculate_slope_regression import *
 from utils.calculate_angle import *
 from utils.weightedaverage import *
 from utils.find_path import *
-
-def find_angles(tg_binary, skeleton, contour, pix, ns, nc):
-
-    # list of pixels that belong to the skeleton
-    skeleton_list = np.argwhere(skeleton>0).astype(int)
-
-    # list of pixels that belong to the contour
-    contour_list = np.argwhere(contour>0).astype(int)
-
-    # initialize containers to store the slopes and angles
-    slope_c = None
-    slope_s = None
-    angle_s = None
-    angle_c = None
-    slope_av = None
-    angle_av = None
+from utils.bank_labels import same_bank
+
+def points_on(points, mask):
+    # Returns the points that belong to mask (skeleton or contour raster), keeping their order
+    points = points.reshape(-1, 2)
+    return points[mask[points[:, 0], points[:, 1]] > 0]
+
+def connected_points(pix, points, skeleton, labels=None):
+    # Returns a boolean array telling which points can be reached from pix without crossing the skeleton.
+    # With a bank label map this is a single lookup, otherwise a path is searched for every point.
+    if labels is not None:
+        return same_bank(labels, pix, points)
+    return np.array([find_path(pix, point, skeleton) is not None for point in points], dtype=bool)
+
+def find_angle_neighbors(tg_binary, skeleton, contour, pix, ns, nc, labels=None):
+    # Collects the skeleton points around ns and the contour points around nc that are
+    # used to estimate the flow direction at pix. Both are returned as arrays of shape (k, 2);
+    # a set that is not used for pix is empty.
+    ns_s_n = np.empty((0, 2), dtype=int)
+    nc_c_n = np.empty((0, 2), dtype=int)
 
     # if pix is in skeleton
     if skeleton[pix[0], pix[1]] > 0 and contour[pix[0], pix[1]] == 0:
         
         # identify the pixel's first and second neighbors 
         ns_neighbors = find_all_neighbors(tg_binary, ns, 2)
-        ns_neighbors = [*ns_neighbors[0], *ns_neighbors[1]]
+        ns_neighbors = np.vstack(ns_neighbors[:2])
 
-        # now identify first and second neighbors that are in skeleton_list
-        ns_s_n = (ns, *[n for n in ns_neighbors if any(np.array_equal(n, r) for r in skeleton_list)])
-
-        # calculate slope and angle
-        slope_s = calculate_slope_regression(ns_s_n)
-
-        angle_s = calculate_angle(slope_s)
+        # now identify first and second neighbors that are in the skeleton
+        ns_s_n = np.array((ns, *points_on(ns_neighbors, skeleton)))
 
     # if pix is in contour
     elif contour[pix[0], pix[1]] > 0 and skeleton[pix[0], pix[1]] == 0:
 
         # identify the pixel's first and second neighbors
         nc_neighbors = find_all_neighbors(tg_binary, nc, 2)
-        nc_neighbors = [*nc_neighbors[0], *nc_neighbors[1]]
+        nc_neighbors = np.vstack(nc_neighbors[:2])
 
-        # now identify first and second neighbors that are in contour_list
-        nc_c_n_candidates = (nc, *[n for n in nc_neighbors if any(np.array_equal(n, r) for r in contour_list)])
-        nc_c_n = []
+        # now identify first and second neighbors that are in the contour
+        nc_c_n_candidates = np.array((nc, *points_on(nc_neighbors, contour)))
 
-        for candidate_point in nc_c_n_candidates:
-            # check if there is a valid path on the grid between pix and candidate_point
-            path = find_path(pix, candidate_point, skeleton) # a valid path can't cross the skeleton!
-
-            if path is not None:
-                nc_c_n.append(candidate_point)
-                
-        # calculate slope and angle
-        slope_c = calculate_slope_regression(nc_c_n)
-
-        angle_c = calculate_angle(slope_c)
+        # keep the candidates that can be reached from pix without crossing the skeleton
+        nc_c_n = nc_c_n_candidates[connected_points(pix, nc_c_n_candidates, skeleton, labels)]
 
     # if pix is neither in skeleton nor in contour
-    else:
+    # (without a closest skeleton and contour point there is no estimate)
+    elif ns is not None and nc is not None:
         # identify the closest skeleton point's first and second neighbors
         ns_neighbors = find_all_neighbors(tg_binary,ns, 2)
-        ns_neighbors = [*ns_neighbors[0], *ns_neighbors[1]]
+        ns_neighbors = np.vstack(ns_neighbors[:2])
 
-        # now identify first and second neighbors that are in skeleton_list
-        ns_s_n = (ns, *[n for n in ns_neighbors if any(np.array_equal(n, r) for r in skeleton_list)])
+        # now identify first and second neighbors that are in the skeleton
+        ns_s_n = np.array((ns, *points_on(ns_neighbors, skeleton)))
         ns_s_n = ns_s_n[:5]
 
-        # calculate slope
-        slope_s = calculate_slope_regression(ns_s_n)
-
         # identify the closest contour point's first and second neighbors
         # start with some extra neighbors in case we need to remove some due to invalid paths (see below)
         nc_neighbors = find_all_neighbors(tg_binary, nc, 3) 
-        nc_neighbors = [*nc_neighbors[0], *nc_neighbors[1]]
+        nc_neighbors = np.vstack(nc_neighbors[:2])
 
-        # now identify first and second neighbors that are in contour_list, without crossing skeleton line
-        nc_c_n = (nc, *[n for n in nc_neighbors if any(np.array_equal(n, r) for r in contour_list)])
+        # now identify first and second neighbors that are in the contour, without crossing skeleton line
+        nc_c_n = np.array((nc, *points_on(nc_neighbors, contour)))
         
         # this part ensures that we aren't crossing the skeleton line to find the nearest contour points
         # this can be an issue is the river is only a few pixels wide (points on the opposite riverbank may
         # be closer to the closest contour point than other contour points up- or downstream)
-        for nc_c_n_point in nc_c_n:
-            path = find_path(pix, nc_c_n_point, skeleton) # a valid path can't cross the skeleton!
-            # if no valid path is found, remove the point from the list
-            if path is None: 
-                nc_c_n_list = list(nc_c_n)
-                nc_c_n_list = list(filter(lambda x: not np.array_equal(x, nc_c_n_point), nc_c_n_list))
-                nc_c_n = tuple(nc_c_n_list)
+        nc_c_n = nc_c_n[connected_points(pix, nc_c_n, skeleton, labels)]
                 
         # only use the closest 5 points (this is in case we didn't delete any invalid points above)        
         nc_c_n = nc_c_n[:5]
-        
-        # calculate slope
-        slope_c = calculate_slope_regression(nc_c_n)
+
+    return ns_s_n, nc_c_n
+
+def has_angle_estimate(ns_s_n, nc_c_n):
+    # At least one of the neighbor sets needs two points to fit a slope
+    return len(ns_s_n) >= 2 or len(nc_c_n) >= 2
+
+def pad_point_sets(point_sets):
+    # Stacks point sets of different sizes into an array of shape (K, M, 2) plus their sizes
+    counts = np.array([len(points) for points in point_sets], dtype=int)
+    padded = np.zeros((len(point_sets), max(counts.max(initial=0), 1), 2))
+    for i, points in enumerate(point_sets):
+        padded[i, :counts[i]] = points
+    return padded, counts
+
+def find_angles_batch(pixels, nss, ncs, ns_sets, nc_sets):
+    # Computes slopes and angles for all sampled points at once.
+    # pixels, nss, ncs: sampled pixels and their closest skeleton and contour points (None if missing)
+    # ns_sets, nc_sets: neighbor sets returned by find_angle_neighbors for each pixel
+    # Returns arrays slope_c, slope_s, slope_av, angle_av; missing slopes are NaN.
+    pixels = np.asarray(pixels)
+    nss = np.array([(-1, -1) if ns is None else ns for ns in nss])
+    ncs = np.array([(-1, -1) if nc is None else nc for nc in ncs])
+
+    slope_s = calculate_slope_regression_batch(*pad_point_sets(ns_sets))
+    slope_c = calculate_slope_regression_batch(*pad_point_sets(nc_sets))
+
+    has_s = ~np.isnan(slope_s)
+    has_c = ~np.isnan(slope_c)
+
+    slope_av = np.where(has_s, slope_s, slope_c)
+    both = has_s & has_c
+    if both.any():
+        slope_av[both] = weightedaverage_batch(pixels[both], ncs[both], nss[both], slope_c[both], slope_s[both])
+
+    angle_av = calculate_angle_batch(slope_av)
+
+    return slope_c, slope_s, slope_av, angle_av
+
+def find_angles(tg_binary, skeleton, contour, pix, ns, nc, labels=None):
+    # Estimates the flow direction at a single pixel.
+    ns_s_n, nc_c_n = find_angle_neighbors(tg_binary, skeleton, contour, pix, ns, nc, labels)
+
+    if not has_angle_estimate(ns_s_n, nc_c_n):
+        raise ValueError(f"Not enough neighbors to estimate the flow direction at {pix}.")
+
+    # calculate slopes
+    slope_s = calculate_slope_regression(ns_s_n)
+    slope_c = calculate_slope_regression(nc_c_n)
 
     if slope_s is not None and slope_c is not None:
         slope_av = weightedaverage(pix, nc, ns, slope_c, slope_s)
-        angle_av = calculate_angle(slope_av)
-
-    if slope_c is None and slope_s is not None:
+    elif slope_s is not None:
         slope_av = slope_s
-        angle_av = calculate_angle(slope_s)
-
-    if slope_s is None and slope_c is not None:
+    else:
         slope_av = slope_c
-        angle_av = calculate_angle(slope_c)
+
+    angle_av = calculate_angle(slope_av)
 
     return slope_c, slope_s, slope_av, angle_av
@@ -1,90 +1,60 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
-from skimage.morphology import skeletonize
-import random
-import os
-from skimage import measure
-from collections import deque
 from utils.find_shortest_path import *
 from utils.find_path import *
+from utils.bank_labels import same_bank
 
-def find_closest_points(center, all_neighbors, contour, skeleton):
-    # number of levels
-    N = len(all_neighbors)
-    
-    # list of pixels in the contour and skeleton
-    contour_list_all = np.argwhere(contour>0).astype(int)
-    skeleton_list_all = np.argwhere(skeleton>0).astype(int)
-
-    contour_list = [p for p in contour_list_all if center[0]-N <= p[0] <= center[0]+N and
-                    center[1]-N <= p[1] <= center[1]+N]
-    skeleton_list = [p for p in skeleton_list_all if center[0]-N <= p[0] <= center[0]+N and
-                    center[1]-N <= p[1] <= center[1]+N]
+def find_closest_points(center, all_neighbors, contour, skeleton, labels=None):
+    # Finds the closest skeleton point and the closest contour point (on the same
+    # side of the skeleton) among the neighbors of center.
+    # The skeleton and contour rasters act as the spatial index: membership of all
+    # neighbors is looked up at once instead of searching the full point lists.
+    # labels:   optional bank label map (see label_banks). If given, the side of the
+    #           skeleton is checked with a label lookup and no path is returned.
 
     if contour[center[0], center[1]] > 0:
         return None, center, [0,0]
 
     if skeleton[center[0], center[1]] > 0:
         return center, None, [0,0]
-    
-    # Initialize the minimum distance and the corresponding points
-    min_distance = float('inf')
-    closest_skeleton = None
 
-    # find closest point on a skeleton
-    for i, neighbors in enumerate(all_neighbors):
-        # check if any point in neighbors is also in skeleton
-        valid_points = [pix for pix in skeleton_list if any(np.array_equal(pix, x) for x in neighbors)]
-        for candidate_point in valid_points:
-            # find the shortest path on the grid between center and candidate_point
-            path = find_shortest_path(skeleton, center, candidate_point)
+    # all neighbors with their level (ring index)
+    rings = [np.asarray(neighbors).reshape(-1, 2) for neighbors in all_neighbors]
+    coords = np.vstack(rings).astype(int)
+    levels = np.repeat(np.arange(len(rings)), [len(neighbors) for neighbors in rings])
 
-            # calculate the distance to the candidate skeleton point
-            distance = np.sqrt((candidate_point[0] - center[0])**2 + (candidate_point[1] - center[1])**2)
+    # squared distances are integers, so ties are resolved exactly
+    distance2 = (coords[:, 0] - center[0])**2 + (coords[:, 1] - center[1])**2
 
-            # if the candidate point is closer, update the minimum distance and the corresponding point
-            if distance < min_distance:
-                min_distance = distance
-                closest_skeleton = candidate_point
-                
-    # Initialize the minimum distance and the corresponding points
-    min_distance = float('inf')
+    # find closest point on a skeleton
+    # ties are resolved in favor of the lower level, then the first point in row-major order
+    closest_skeleton = None
+    on_skeleton = skeleton[coords[:, 0], coords[:, 1]] > 0
+    if on_skeleton.any():
+        candidates = coords[on_skeleton]
+        order = np.lexsort((candidates[:, 1], candidates[:, 0], levels[on_skeleton], distance2[on_skeleton]))
+        closest_skeleton = candidates[order[0]]
+
+    # find closest point on a contour
+    # candidate points are visited level by level, sorted by distance within each level
     closest_contour = None
     best_path = None
-    found_path = False
-    
-    # find closest point on a contour
-    for i, neighbors in enumerate(all_neighbors):
-        # check if any point in neighbors is also in contour
-        valid_points = [pix for pix in contour_list if any(np.array_equal(pix, x) for x in neighbors)]
-        # sort candidate points by distance
-        if len(valid_points)>0:
-            valid_points_arr = np.array(valid_points)
-            valid_points_list = [l.tolist() for l in valid_points]
-            distance = np.sqrt((valid_points_arr[:,0] - center[0])**2 +
-                           (valid_points_arr[:,1] - center[1])**2)
-            valid_points = [x for d,x in sorted(zip(distance,valid_points_list))]
-        
-        for candidate_point in valid_points:
-            # check if there is a valid path on the grid between center and candidate_point
-            path = find_path(center, candidate_point, skeleton) # a valid path can't cross the skeleton!
-
-
-            # if the candidate point is closer, update the minimum distance and the corresponding point
-            if path is not None:
-                found_path = True
-                closest_contour = np.array(candidate_point)
-                best_path = path
-                break
-
-        if found_path == True:
+    on_contour = contour[coords[:, 0], coords[:, 1]] > 0
+    candidates = coords[on_contour]
+    order = np.lexsort((candidates[:, 1], candidates[:, 0], distance2[on_contour], levels[on_contour]))
+
+    if labels is not None:
+        valid = np.flatnonzero(same_bank(labels, center, candidates[order]))
+        if len(valid) > 0:
+            closest_contour = candidates[order[valid[0]]]
+        return closest_skeleton, closest_contour, best_path
+
+    for candidate_point in candidates[order]:
+        # check if there is a valid path on the grid between center and candidate_point
+        path = find_path(center, candidate_point, skeleton) # a valid path can't cross the skeleton!
+
+        if path is not None:
+            closest_contour = candidate_point
+            best_path = path
             break
-    
-    return closest_skeleton, closest_contour, best_path
-
-        
-
-
-
 
+    return closest_skeleton, closest_contour, best_path
@@ -1,7 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
-import random
 
 def find_neighbors(matrix, start_pixel, n):
     rows, cols = len(matrix), len(matrix[0])
@@ -36,11 +33,49 @@ def find_neighbors(matrix, start_pixel, n):
 
     return neighbors
 
-def find_all_neighbors(matrix, start_pixel, N):
-    # finds all neighbors up to level N
-    all_neighbors = []
+# Possible moves (including diagonals), in the same order as in find_neighbors
+MOVES = np.array([(-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)])
+
+def find_neighbor_rings(matrix, start_pixel, N):
+    # Finds all neighbors up to level N with a single breadth-first search.
+    # Each level is expanded as a whole, so the pixels of every ring are returned
+    # in the same order as find_neighbors would visit them.
+    # Pixels that are N steps away lie within N rows/columns of the start pixel,
+    # so the search is restricted to that window.
+    matrix = np.asarray(matrix)
+    rows, cols = matrix.shape
+    r0, c0 = max(start_pixel[0] - N, 0), max(start_pixel[1] - N, 0)
+    r1, c1 = min(start_pixel[0] + N + 1, rows), min(start_pixel[1] + N + 1, cols)
+
+    # Window of pixels that are part of the river and not yet visited
+    open_pixels = matrix[r0:r1, c0:c1] == 1
+    window_cols = c1 - c0
+
+    frontier = np.array([[start_pixel[0] - r0, start_pixel[1] - c0]])
+    open_pixels[frontier[0, 0], frontier[0, 1]] = False
+
+    rings = []
     for n in range(1, N+1):
-        neighbors = find_neighbors(matrix, start_pixel, n)
-        all_neighbors.append(np.array(neighbors))
-    return all_neighbors
+        if len(frontier) == 0:
+            rings.append(np.empty((0, 2), dtype=int))
+            continue
 
+        # Candidates in queue order: for each pixel of the previous ring, every move in turn
+        candidates = (frontier[:, None, :] + MOVES[None, :, :]).reshape(-1, 2)
+        inside = ((candidates[:, 0] >= 0) & (candidates[:, 0] < r1 - r0) &
+                  (candidates[:, 1] >= 0) & (candidates[:, 1] < window_cols))
+        candidates = candidates[inside]
+        candidates = candidates[open_pixels[candidates[:, 0], candidates[:, 1]]]
+
+        # Keep the first occurrence of each pixel (it is marked as visited when first queued)
+        _, first = np.unique(candidates[:, 0] * window_cols + candidates[:, 1], return_index=True)
+        frontier = candidates[np.sort(first)]
+        open_pixels[frontier[:, 0], frontier[:, 1]] = False
+
+        rings.append(frontier + [r0, c0])
+
+    return rings
+
+def find_all_neighbors(matrix, start_pixel, N):
+    # finds all neighbors up to level N
+    return find_neighbor_rings(matrix, start_pixel, N)
@@ -0,0 +1,247 @@
+import numpy as np
+import os
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from utils.find_neighbors import find_neighbor_rings
+from utils.calculate_slope_regression import calculate_slope_regression_batch
+from utils.calculate_angle import calculate_angle_batch
+from utils.weightedaverage import weightedaverage_batch
+from utils.bank_labels import label_banks
+from utils.geometry_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, load_geometry, image_key, save_bundle, evict_cache
+
+# Bump when the estimator or the stored format changes, so that cached fields are recomputed
+FIELD_VERSION = 2
+
+# Offsets of the first and second neighbors, in the order in which find_all_neighbors returns them
+STENCIL = np.vstack(find_neighbor_rings(np.ones((5, 5)), (2, 2), 2)) - 2
+
+def stencil_slopes(points, mask, labels=None, limit=None):
+    # Fits a slope through each point and its first and second neighbors on mask
+    # (the same neighbor sets as find_angle_neighbors, taken from a fixed stencil).
+    # labels: if given, only neighbors on the same bank as the point are used
+    # limit:  maximum number of points per fit (the point itself included)
+    rows, cols = mask.shape
+    candidates = np.concatenate([points[:, None, :], points[:, None, :] + STENCIL[None, :, :]], axis=1)
+    inside = ((candidates[:, :, 0] >= 0) & (candidates[:, :, 0] < rows) &
+              (candidates[:, :, 1] >= 0) & (candidates[:, :, 1] < cols))
+    r = np.clip(candidates[:, :, 0], 0, rows - 1)
+    c = np.clip(candidates[:, :, 1], 0, cols - 1)
+
+    valid = inside & (mask[r, c] > 0)
+    valid[:, 0] = True
+    if labels is not None:
+        point_labels = labels[points[:, 0], points[:, 1]]
+        valid &= (labels[r, c] == point_labels[:, None]) & (point_labels[:, None] > 0)
+    if limit is not None:
+        valid &= np.cumsum(valid, axis=1) <= limit
+
+    # Move the valid points to the front of each row, keeping their order
+    order = np.argsort(~valid, axis=1, kind='stable')
+    candidates = np.take_along_axis(candidates, order[:, :, None], axis=1)
+    return calculate_slope_regression_batch(candidates, valid.sum(axis=1))
+
+def nearest_contour_on_bank(contour, labels, pixels, k=16):
+    # Flat index of the closest contour point on the same bank for each of the given
+    # pixels (flat indices), -1 if there is none.
+    # Like the ring search in find_closest_points, contour points are ranked by chessboard
+    # distance first, then by Euclidean distance and finally by their coordinates.
+    cols = contour.shape[1]
+    nearest = np.full(len(pixels), -1, dtype=np.int64)
+
+    pixel_labels = labels.ravel()[pixels]
+    contour_points = np.argwhere(contour > 0)
+    contour_labels = labels[contour_points[:, 0], contour_points[:, 1]]
+
+    for label in np.intersect1d(np.unique(pixel_labels), contour_labels):
+        if label == 0:
+            continue
+        members = np.flatnonzero(pixel_labels == label)
+        points = np.column_stack(np.unravel_index(pixels[members], contour.shape))
+        targets = contour_points[contour_labels == label]
+
+        # the k nearest contour points in chessboard distance (at least all ties for small rivers)
+        n_query = min(k, len(targets))
+        distance, idx = cKDTree(targets).query(points, k=n_query, p=np.inf)
+        distance, idx = distance.reshape(len(points), n_query), idx.reshape(len(points), n_query)
+
+        candidates = targets[idx]
+        distance2 = ((candidates - points[:, None, :])**2).sum(axis=2)
+        order = np.lexsort((candidates[:, :, 1], candidates[:, :, 0], distance2, distance), axis=-1)
+        best = candidates[np.arange(len(points)), order[:, 0]]
+        nearest[members] = best[:, 0] * cols + best[:, 1]
+    return nearest
+
+def index_dtype(shape):
+    # int32 flat indices where they fit, int64 for images of more than 2**31 pixels
+    return np.int32 if np.prod(shape, dtype=np.int64) < 2**31 else np.int64
+
+def lookup(points, values, indices):
+    # Values of the given flat indices, which must be among points (sorted flat indices)
+    return values[np.searchsorted(points, indices)]
+
+def compute_flow_field(tg_binary, skeleton, contour, labels, N=40, edge=10):
+    # Estimates the flow direction for every river pixel at once.
+    # The closest skeleton point is the Euclidean nearest skeleton pixel and the closest
+    # contour point the nearest (chessboard distance) contour pixel on the same bank; both must lie within N
+    # rows/columns, like the neighbors searched by generate_points.
+    # Only the river pixels are stored: 'river' holds their flat indices (sorted) and the other arrays one
+    # value per river pixel, float32 for the slopes and angles (NaN where there is no estimate) and flat
+    # indices for the closest points (-1 if missing). 'eligible' holds the flat indices of the pixels
+    # that can be sampled.
+    rows, cols = tg_binary.shape
+    skeleton = skeleton > 0
+    contour = contour > 0
+
+    # Slopes along the skeleton and the contour, one per skeleton/contour pixel (in flat index order)
+    skeleton_points = np.argwhere(skeleton)
+    contour_points = np.argwhere(contour)
+    skeleton_flat = np.flatnonzero(skeleton)
+    contour_flat = np.flatnonzero(contour)
+    skeleton_slope_all = np.full(len(skeleton_points), np.nan)
+    skeleton_slope_5 = np.full(len(skeleton_points), np.nan)
+    contour_slope_all = np.full(len(contour_points), np.nan)
+    contour_slope_5 = np.full(len(contour_points), np.nan)
+    if len(skeleton_points) > 0:
+        skeleton_slope_all[:] = stencil_slopes(skeleton_points, skeleton)
+        skeleton_slope_5[:] = stencil_slopes(skeleton_points, skeleton, limit=5)
+    if len(contour_points) > 0:
+        contour_slope_all[:] = stencil_slopes(contour_points, contour, labels)
+        contour_slope_5[:] = stencil_slopes(contour_points, contour, labels, limit=5)
+
+    # Closest skeleton and contour points
+    river = np.flatnonzero(tg_binary > 0)
+    pix = np.column_stack(np.unravel_index(river, tg_binary.shape))
+
+    ri, ci = ndimage.distance_transform_edt(~skeleton, return_distances=False, return_indices=True)
+    ns = np.column_stack([ri.ravel()[river], ci.ravel()[river]])
+    del ri, ci
+    nc_flat = nearest_contour_on_bank(contour, labels, river)
+    nc = np.column_stack(np.unravel_index(np.maximum(nc_flat, 0), tg_binary.shape))
+
+    has_ns = np.all(np.abs(ns - pix) <= N, axis=1) & skeleton.any()
+    has_nc = (nc_flat >= 0) & np.all(np.abs(nc - pix) <= N, axis=1)
+    ns_flat = ns[:, 0] * cols + ns[:, 1]
+
+    on_skeleton = skeleton.ravel()[river]
+    on_contour = contour.ravel()[river]
+
+    slope_s = np.full(len(river), np.nan)
+    slope_c = np.full(len(river), np.nan)
+
+    # pixels on the skeleton use all skeleton neighbors, pixels on the contour all contour neighbors
+    only_s = on_skeleton & ~on_contour
+    only_c = on_contour & ~on_skeleton
+    slope_s[only_s] = lookup(skeleton_flat, skeleton_slope_all, river[only_s])
+    slope_c[only_c] = lookup(contour_flat, contour_slope_all, river[only_c])
+
+    # other pixels use up to 5 points around the closest skeleton and contour points
+    inner = ~on_skeleton & ~on_contour & has_ns & has_nc
+    slope_s[inner] = lookup(skeleton_flat, skeleton_slope_5, ns_flat[inner])
+    slope_c[inner] = lookup(contour_flat, contour_slope_5, nc_flat[inner])
+
+    has_s = ~np.isnan(slope_s)
+    has_c = ~np.isnan(slope_c)
+    slope_av = np.where(has_s, slope_s, slope_c)
+    both = has_s & has_c
+    slope_av[both] = weightedaverage_batch(pix[both], nc[both], ns[both], slope_c[both], slope_s[both])
+    angle_av = calculate_angle_batch(slope_av)
+
+    ns_out = np.where(on_contour & ~on_skeleton, -1, np.where(inner | only_s, ns_flat, -1))
+    nc_out = np.where(on_skeleton & ~on_contour, -1, np.where(inner, nc_flat, np.where(only_c, river, -1)))
+
+    # Pixels that can be sampled: a valid estimate, away from the image edge
+    valid = ~np.isnan(angle_av)
+    valid &= (pix[:, 0] >= edge) & (pix[:, 0] < rows - edge) & (pix[:, 1] >= edge) & (pix[:, 1] < cols - edge)
+
+    flat = index_dtype(tg_binary.shape)
+    return {
+        'shape': np.array(tg_binary.shape),
+        'river': river.astype(flat),
+        'slope at nc': slope_c.astype(np.float32),
+        'slope at ns': slope_s.astype(np.float32),
+        'average slope': slope_av.astype(np.float32),
+        'average angle': angle_av.astype(np.float32),
+        'ns': ns_out.astype(flat),
+        'nc': nc_out.astype(flat),
+        'eligible': river[valid].astype(flat),
+    }
+
+def field_path(image_path, N, threshold, cache_dir, part='field'):
+    # Cache file of the dense field ('field') or of its eligible pixels only ('eligible')
+    return os.path.join(cache_dir, f"{image_key(image_path, threshold)}_N{N}_{part}_v{FIELD_VERSION}.npz")
+
+def load_cached(path, keys=None):
+    # Arrays of a cached bundle (only the given keys, if any), None if it is missing or unreadable
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as bundle:
+            arrays = {key: bundle[key] for key in (keys or bundle.files)}
+    except (OSError, ValueError, KeyError):
+        return None
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return arrays
+
+def load_flow_field(image_path, N=40, threshold=128, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    # Returns the dense flow field of an image, computing it only once per image and N.
+    if cache_dir is not None:
+        path = field_path(image_path, N, threshold, cache_dir)
+        field = load_cached(path)
+        if field is not None:
+            return field
+
+    geometry = load_geometry(image_path, threshold, cache_dir, max_bytes)
+    labels = label_banks(geometry['binary'], geometry['skeleton'])
+    field = compute_flow_field(geometry['binary'], geometry['skeleton'], geometry['contour'], labels, N)
+
+    if cache_dir is not None:
+        save_bundle(path, **field)
+        evict_cache(cache_dir, max_bytes)
+    return field
+
+def load_eligible(image_path, geometry, labels, N=40, threshold=128, cache_dir=DEFAULT_CACHE_DIR,
+                  max_bytes=DEFAULT_MAX_BYTES):
+    # Returns the flat indices of the pixels that have a flow direction estimate (see compute_flow_field),
+    # for sampling without the dense field. Only these indices are cached; they are taken from a cached
+    # dense field if there is one.
+    if cache_dir is not None:
+        path = field_path(image_path, N, threshold, cache_dir, 'eligible')
+        for cached in (path, field_path(image_path, N, threshold, cache_dir)):
+            arrays = load_cached(cached, ['eligible'])
+            if arrays is not None:
+                return arrays['eligible']
+
+    eligible = compute_flow_field(geometry['binary'], geometry['skeleton'], geometry['contour'], labels, N)['eligible']
+
+    if cache_dir is not None:
+        save_bundle(path, eligible=eligible)
+        evict_cache(cache_dir, max_bytes)
+    return eligible
+
+def sample_flow_field(field, K, rng=None):
+    # Draws K pixels (with replacement) from the eligible pixels of a dense flow field.
+    # Returns the same arrays as sample_points.
+    if rng is None:
+        rng = np.random.default_rng()
+    shape = tuple(field['shape'])
+    flat = rng.choice(field['eligible'], size=K)
+    position = np.searchsorted(field['river'], flat)
+
+    def as_points(indices):
+        indices = indices.astype(np.int64)
+        points = np.column_stack(np.unravel_index(np.maximum(indices, 0), shape))
+        points[indices < 0] = -1
+        return points
+
+    return {
+        'pixel': as_points(flat),
+        'closest contour point': as_points(field['nc'][position]),
+        'closest skeleton point': as_points(field['ns'][position]),
+        'slope at nc': field['slope at nc'][position].astype(float),
+        'slope at ns': field['slope at ns'][position].astype(float),
+        'average slope': field['average slope'][position].astype(float),
+        'average angle': field['average angle'][position].astype(float),
+    }
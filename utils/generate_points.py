@@ -1,114 +1,133 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.integrate import quad
-import pandas as pd
-from PIL import Image
-from skimage.morphology import skeletonize
-from skimage import measure
-import random
-import sys
-import os
+from utils.geometry_cache import load_geometry
+from utils.bank_labels import label_banks
+from utils.flow_field import load_flow_field, load_eligible, sample_flow_field
+from utils.points_io import points_dataframe
 from utils.find_closest_points import *
 from utils.find_angles import *
 from utils.find_neighbors import *
 from utils.plot_line_segment import *
 
-def generate_points(args):
+def river_candidates(tg_binary, edge=10):
+    # Flat indices of the river pixels that can be sampled.
+    # Points will not be sampled in the outermost edge pixels of the image
+    h, w = tg_binary.shape
+    interior = np.zeros((h, w), dtype=bool)
+    interior[edge:h - edge, edge:w - edge] = True
+    return np.flatnonzero((tg_binary > 0) & interior)
+
+def point_neighbors(tg_binary, skeleton, contour, labels, pix, N=40):
+    # Finds the closest skeleton and contour points of pix and the neighbor sets used to
+    # estimate its flow direction. Returns None if pix has no valid estimate.
+
+    # Find neighbors
+    neighbors = find_all_neighbors(tg_binary, pix, N)
+    # Find closest contour and skeleton points
+    ns, nc, path = find_closest_points(pix, neighbors, contour, skeleton, labels)
+
+    # If pix is neither in skeleton nor in contour, it needs valid contour and skeleton points
+    if skeleton[pix[0], pix[1]] == 0 and contour[pix[0], pix[1]] == 0 and (nc is None or ns is None):
+        return None
+
+    # Find the neighbors used to calculate the slopes
+    ns_s_n, nc_c_n = find_angle_neighbors(tg_binary, skeleton, contour, pix, ns, nc, labels)
+    if not has_angle_estimate(ns_s_n, nc_c_n):
+        return None
+
+    return ns, nc, ns_s_n, nc_c_n
+
+def sample_points(tg_binary, skeleton, contour, labels, K, rng=None, candidates=None, max_rounds=10):
+    # This function randomly samples K pixels from a river and approximates the flow direction.
+    # It only needs the per-image geometry, so it can run on arrays shared between processes.
+    # rng:        numpy random Generator, defaults to a freshly seeded one
+    # candidates: flat indices of the pixels to sample from, defaults to river_candidates.
+    #             Use the eligible pixels of the flow field (see flow_field.py), so that
+    #             (almost) every drawn pixel has a valid estimate.
+    # max_rounds: pixels without a valid estimate are redrawn, all at once, at most max_rounds times
+    # Returns a dictionary of numeric arrays (missing closest points are (-1, -1),
+    # missing slopes are NaN) and the number of pixels that were drawn but skipped.
+
+    h, w = tg_binary.shape
+
+    if rng is None:
+        rng = np.random.default_rng()
+    if candidates is None:
+        candidates = river_candidates(tg_binary)
+    if len(candidates) == 0:
+        raise ValueError("The image has no river pixels to sample from.")
+
+    # Initialize containers for generated points and the neighbor sets used for their directions
+    pixels, ncs, nss, ns_sets, nc_sets = [], [], [], [], []
+    skipped = 0
+
+    for _ in range(max_rounds):
+        if len(pixels) == K:
+            break
+
+        # Randomly select all missing pixels at once
+        drawn = rng.choice(candidates, size=K - len(pixels))
+        drawn = np.column_stack(np.unravel_index(drawn, (h, w)))
+
+        # Generate points
+        for pix in drawn:
+            found = point_neighbors(tg_binary, skeleton, contour, labels, pix)
+            if found is None:
+                skipped += 1
+                continue
+            ns, nc, ns_s_n, nc_c_n = found
+
+            # Append data to lists
+            pixels.append(pix)
+            ncs.append(nc)
+            nss.append(ns)
+            ns_sets.append(ns_s_n)
+            nc_sets.append(nc_c_n)
+
+    if len(pixels) < K:
+        raise ValueError(f"Only {len(pixels)} of {K} points have a valid flow direction "
+                         f"after {max_rounds} rounds ({skipped} pixels skipped).")
+
+    # Calculate slopes and angles for all points at once
+    slopes_nc, slopes_ns, slopes, angles = find_angles_batch(pixels, nss, ncs, ns_sets, nc_sets)
+
+    def as_points(points):
+        return np.array([(-1, -1) if p is None else p for p in points], dtype=int).reshape(-1, 2)
+
+    points = {
+        'pixel': as_points(pixels),
+        'closest contour point': as_points(ncs),
+        'closest skeleton point': as_points(nss),
+        'slope at nc': slopes_nc,
+        'slope at ns': slopes_ns,
+        'average slope': slopes,
+        'average angle': angles,
+    }
+    return points, skipped
+
+def generate_points(args, dense=False):
     # This function generates randomly sampled points from an image,
     # approximates the flow direction, and saves the sampled points.
+    # dense: if True, the flow direction is estimated once for every river pixel
+    #        (see flow_field.py, cached per image) and the K points are drawn from that field.
 
     # Unpack arguments
     image_path, file_path, K, plot = args
 
-    # Import image
-    image_name = os.path.basename(image_path)
-
-    tg = Image.open(image_path)
-
-    w, h = tg.size
-
-    # Convert image to binary
-    tg_binary = tg.convert('L')
-    tg_binary = np.array(tg_binary)
-    tg_binary[tg_binary < 128] = 0
-    tg_binary[tg_binary >= 128] = 1
-
-    tg_binary_river = np.argwhere(tg_binary > 0)
-    
-    # Find river skeleton
-    skeleton = skeletonize(tg_binary, method='lee')
-    skeleton_list = np.argwhere(skeleton > 0).astype(int)
-    
-    # Find river contours
-    contour_list = measure.find_contours(1 - tg_binary, 0)
-    contour_list = np.vstack(contour_list).astype(int)
-
-    contour = np.zeros([tg_binary.shape[0], tg_binary.shape[1]])
-    for item in contour_list:
-        contour[item[0], item[1]] = 1
-
-    # Apply edge filter
-    # Points will not be sampled in the outermost 10 pixels of the image
-    filtered_coords = [coord for coord in tg_binary_river
-                       if 10 <= coord[0] < h - 10 and 10 <= coord[1] < w - 10
-                       ]
-
-    # Randomly select pixels
-    pixels = [random.choice(filtered_coords) for _ in range(K)]
-
-    # Initialize containers for generated points and directions
-    ncs, nss, slopes_nc, slopes_ns, slopes, angles = [], [], [], [], [], []
-
-    # Generate points 
-    for i in range(len(pixels)):
-        pix = pixels[i]
-        # Set neighbor search radius
-        N = 40
-        # Find neighbors
-        neighbors = find_all_neighbors(tg_binary, pix, N)
-        # Find closest contour and skeleton points
-        ns, nc, path = find_closest_points(pix, neighbors, contour, skeleton)
-
-        # If pix is neither in skeleton nor in contour
-        if skeleton[pix[0], pix[1]] == 0 and contour[pix[0], pix[1]] == 0:
-            # Check for valid contour and skeleton points, otherwise replace
-            while nc is None or ns is None:
-                pix = random.choice(filtered_coords)
-                neighbors = find_all_neighbors(tg_binary, pix, N)
-                ns, nc, path = find_closest_points(pix, neighbors, contour, skeleton)
-            pixels[i] = pix
-                        
-        # Calculate slopes and angles
-        found_angles = False
-        while found_angles == False:
-            try:
-                slope_nc, slope_ns, slope_av, angle_av = find_angles(tg_binary, skeleton, contour, pix, ns, nc)
-            except:
-                pix = random.choice(filtered_coords)
-                neighbors = find_all_neighbors(tg_binary, pix, N)
-                ns, nc, path = find_closest_points(pix, neighbors, contour, skeleton)
-                pixels[i] = pix
-            else:
-                found_angles = True
-        
-        # Append data to lists
-        ncs.append(nc)
-        nss.append(ns)
-        slopes_nc.append(slope_nc)
-        slopes_ns.append(slope_ns)
-        slopes.append(float(slope_av))
-        angles.append(float(angle_av))
-
-    # Create dataframe for saving
-    df = pd.DataFrame({
-        'pixel': pixels,
-        'closest contour point': ncs,
-        'closest skeleton point': nss,
-        'slope at nc': slopes_nc,
-        'slope at ns': slopes_ns,
-        'average slope': slopes,
-        'average angle': angles
-    })
+    if dense:
+        return points_dataframe(sample_flow_field(load_flow_field(image_path), K))
+
+    # Load binary image, skeleton and contours (cached per image)
+    geometry = load_geometry(image_path)
+
+    # Split the river into regions on either side of the skeleton
+    labels = label_banks(geometry['binary'], geometry['skeleton'])
+
+    # Only sample pixels that are known to have a flow direction estimate
+    eligible = load_eligible(image_path, geometry, labels)
+
+    # Generate points
+    points, skipped = sample_points(geometry['binary'], geometry['skeleton'], geometry['contour'],
+                                    labels, K, candidates=eligible)
 
     # Save data
-    return df
+    return points_dataframe(points)
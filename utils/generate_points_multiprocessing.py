@@ -1,65 +1,113 @@
-from utils.generate_points import generate_points
+import numpy as np
+from utils.generate_points import sample_points
 import multiprocessing as mp
-import pandas as pd
-import matplotlib.pyplot as plt
-from PIL import Image
+from utils.geometry_cache import load_geometry
+from utils.bank_labels import label_banks
+from utils.flow_field import load_flow_field, load_eligible, sample_flow_field
+from utils.points_io import write_points
+from utils.tiled_geometry import build_tiled_geometry
 from utils.plot_line_segment import *
 import os
+import random
+import tempfile
 
-def generate_points_multiprocessing(args):
+# Geometry shared with the worker processes, set by init_worker
+shared_geometry = {}
+
+def init_worker(array_paths):
+    # Memory-map the arrays published by the parent process (read-only, shared through the page cache)
+    for key, path in array_paths.items():
+        shared_geometry[key] = np.load(path, mmap_mode='r')
+
+def sample_points_worker(args):
+    # Per-point work for one chunk of points, returns compact numeric arrays and the number of skipped pixels
+    K, seed = args
+    return sample_points(shared_geometry['binary'], shared_geometry['skeleton'],
+                         shared_geometry['contour'], shared_geometry['labels'],
+                         K, np.random.default_rng(seed), shared_geometry['candidates'])
+
+def generate_points_multiprocessing(args, num_workers=None, dense=False, tiled=False, tile_size=2048,
+                                    export_csv=False):
     # This function generates randomly sampled points from an image,
     # approximates the flow direction, and saves the sampled points.
+    # num_workers: number of worker processes, defaults to the number of CPUs
+    # dense:       draw the points from the dense flow field (no worker processes needed)
+    # tiled:       process the image in tiles of tile_size x tile_size pixels from memory-mapped
+    #              files, for images that do not fit into memory. Only TIFF and .npy images are read
+    #              piece by piece (see binarize_to_memmap in tiled_geometry.py).
+    # export_csv:  also write the legacy CSV table when saving to a .npz Points file (see points_io.py)
+    # Returns the number of sampled points and of drawn pixels that were skipped
+    # because they have no valid flow direction estimate.
     
     # Unpack arguments
     image_path, file_path, K, plot = args
-    num_workers = 8
+
+    if dense:
+        points = sample_flow_field(load_flow_field(image_path), K)
+        write_points(file_path, points, export_csv)
+        if plot:
+            plot_points(image_path, load_geometry(image_path)['binary'], points)
+        return {'points': K, 'skipped': 0}
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, K))
 
     # Split the total points K across available workers
     K_per_worker = K // num_workers
     remainder = K % num_workers  # Handle cases where K is not evenly divisible
 
-    # Create argument list for multiprocessing
-    args_list = [[image_path, file_path, K_per_worker + (1 if i < remainder else 0), plot] for i in range(num_workers)]
-
-    with mp.Pool(num_workers) as pool:
-        results = pool.map(generate_points, args_list)  # Use map with lists
+    # Each chunk gets its own random seed
+    args_list = [(K_per_worker + (1 if i < remainder else 0), random.getrandbits(64)) for i in range(num_workers)]
 
-    # Combine results into one DataFrame
-    final_df = pd.concat(results, ignore_index=True)
+    with tempfile.TemporaryDirectory() as shared_dir:
+        # Compute the geometry once in the parent process and publish it as memory-mapped files
+        if tiled:
+            array_paths = build_tiled_geometry(image_path, shared_dir, tile_size)
+        else:
+            geometry = load_geometry(image_path)
+            labels = label_banks(geometry['binary'], geometry['skeleton'])
+            # Only sample pixels that are known to have a flow direction estimate
+            eligible = load_eligible(image_path, geometry, labels)
+            array_paths = {}
+            for key, array in [('binary', geometry['binary']), ('skeleton', geometry['skeleton']),
+                               ('contour', geometry['contour']), ('labels', labels),
+                               ('candidates', eligible)]:
+                array_paths[key] = os.path.join(shared_dir, f"{key}.npy")
+                np.save(array_paths[key], array)
 
-    # Save final DataFrame once
-    final_df.to_csv(file_path, index=False)
+        with mp.Pool(num_workers, initializer=init_worker, initargs=(array_paths,)) as pool:
+            results = pool.map(sample_points_worker, args_list)
 
-    # Plotting
-    if plot:
-        image_name = os.path.basename(image_path)
+        # Combine results
+        points = {key: np.concatenate([r[key] for r, _ in results]) for key in results[0][0]}
 
-        tg = Image.open(image_path)
+        # Save the points once
+        write_points(file_path, points, export_csv)
 
-        w, h = tg.size
+        # Plotting
+        if plot:
+            plot_points(image_path, np.load(array_paths['binary'], mmap_mode='r'), points)
 
-        # Convert image to binary
-        tg_binary = tg.convert('L')
-        tg_binary = np.array(tg_binary)
-        tg_binary[tg_binary < 128] = 0
-        tg_binary[tg_binary >= 128] = 1
+    return {'points': K, 'skipped': sum(skipped for _, skipped in results)}
 
-        slopes = final_df['average slope']
-        pixels = final_df['pixel']
-    
-        colors = plt.cm.rainbow(np.linspace(0, 1, len(pixels)))
-        fig, ax = plt.subplots(figsize=(8, 8))
-        ax.imshow(tg_binary, cmap=plt.cm.gray)
-        ax.set_xlabel("y")
-        ax.set_ylabel("x")
+def plot_points(image_path, tg_binary, points):
+    import matplotlib.pyplot as plt
+    image_name = os.path.basename(image_path)
 
-        for i, pix in enumerate(pixels):
-            if np.abs(slopes[i]) < 1e5:
-                x_line, y_line = plot_line_segment(pix, slopes[i], 5)
-                ax.plot(x_line, y_line, color='b', linewidth=1.0)
-        plt.tight_layout()
-        plt.title(f"{image_name}")
-        plt.show()
+    slopes = points['average slope']
+    pixels = points['pixel']
 
+    colors = plt.cm.rainbow(np.linspace(0, 1, len(pixels)))
+    fig, ax = plt.subplots(figsize=(8, 8))
+    ax.imshow(tg_binary, cmap=plt.cm.gray)
+    ax.set_xlabel("y")
+    ax.set_ylabel("x")
 
-    
+    for i, pix in enumerate(pixels):
+        if np.abs(slopes[i]) < 1e5:
+            x_line, y_line = plot_line_segment(pix, slopes[i], 5)
+            ax.plot(x_line, y_line, color='b', linewidth=1.0)
+    plt.tight_layout()
+    plt.title(f"{image_name}")
+    plt.show()
@@ -0,0 +1,128 @@
+import numpy as np
+import hashlib
+import os
+from PIL import Image
+
+# Geometry bundles are stored per user, so the same image is only processed once
+# no matter which folder (my_unknowns, my_controls, ...) it is loaded from.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'river-processing', 'geometry')
+DEFAULT_MAX_BYTES = 512 * 1024**2
+
+def image_key(image_path, threshold=128):
+    # Content-addressed cache key: hash of the image bytes and the binarization threshold.
+    digest = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return f"{digest.hexdigest()}_t{threshold}"
+
+def compute_geometry(image_path, threshold=128):
+    # This function binarizes an image and extracts the river skeleton and contour.
+    # scikit-image is only imported when a geometry is computed (not for cache hits or in the workers)
+    from skimage.morphology import skeletonize
+    from skimage import measure
+
+    tg = Image.open(image_path)
+
+    # Convert image to binary
+    tg_binary = np.array(tg.convert('L'))
+    tg_binary = (tg_binary >= threshold).astype(np.uint8)
+
+    # Find river skeleton
+    skeleton = skeletonize(tg_binary, method='lee') > 0
+    skeleton_list = np.argwhere(skeleton).astype(int)
+
+    # Find river contours
+    contour_list = measure.find_contours(1 - tg_binary, 0)
+    contour_list = np.vstack(contour_list).astype(int)
+
+    contour = np.zeros(tg_binary.shape, dtype=np.uint8)
+    contour[contour_list[:, 0], contour_list[:, 1]] = 1
+
+    return {
+        'binary': tg_binary,
+        'skeleton': skeleton,
+        'contour': contour,
+        'skeleton_list': skeleton_list,
+        'contour_list': contour_list,
+    }
+
+def save_bundle(path, **arrays):
+    # Writes arrays to a compressed .npz file, replacing it atomically so that
+    # concurrent readers never see a partial bundle.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, path)
+
+def save_geometry(geometry, path):
+    # Rasters are bit-packed, coordinate lists are stored as int32.
+    save_bundle(path,
+                shape=np.array(geometry['binary'].shape),
+                binary=np.packbits(geometry['binary'] > 0),
+                skeleton=np.packbits(geometry['skeleton'] > 0),
+                contour=np.packbits(geometry['contour'] > 0),
+                skeleton_list=geometry['skeleton_list'].astype(np.int32),
+                contour_list=geometry['contour_list'].astype(np.int32))
+
+def read_geometry(path):
+    with np.load(path) as bundle:
+        shape = tuple(bundle['shape'])
+        size = shape[0] * shape[1]
+        return {
+            'binary': np.unpackbits(bundle['binary'], count=size).reshape(shape),
+            'skeleton': np.unpackbits(bundle['skeleton'], count=size).reshape(shape).view(bool),
+            'contour': np.unpackbits(bundle['contour'], count=size).reshape(shape),
+            'skeleton_list': bundle['skeleton_list'].astype(int),
+            'contour_list': bundle['contour_list'].astype(int),
+        }
+
+def evict_cache(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    # Remove least recently used bundles until the cache fits into max_bytes.
+    entries = []
+    for file in os.listdir(cache_dir):
+        if file.endswith('.npz'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, file))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, file in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, file))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def load_geometry(image_path, threshold=128, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    # Returns the binary mask, skeleton and contour of an image, computing them
+    # only if the image has not been processed before.
+    # cache_dir: directory for the geometry bundles. Use None to disable caching.
+    # max_bytes: size limit of the cache directory; least recently used bundles are evicted.
+    if cache_dir is None:
+        return compute_geometry(image_path, threshold)
+
+    path = os.path.join(cache_dir, image_key(image_path, threshold) + '.npz')
+    if os.path.exists(path):
+        try:
+            geometry = read_geometry(path)
+        except (OSError, ValueError, KeyError):
+            # Corrupt or outdated bundle, recompute below
+            pass
+        else:
+            # Mark as recently used
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            return geometry
+
+    geometry = compute_geometry(image_path, threshold)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_geometry(geometry, path)
+    evict_cache(cache_dir, max_bytes)
+    return geometry
@@ -1,14 +1,63 @@
+import os
 import numpy as np
-from count_mismatches import *
+import pandas as pd
+import multiprocessing as mp
+from datetime import datetime
+from count_mismatches import load_calibration_corpus, corpus_mismatches
 
-def optimize_bandwidth(calibration_folder, sgr_folder, plot=False):
-    bws = np.arange(1, 16, step=1.0)
-    mismatch_counts = []
-    for bw in bws:
-        m = count_mismatches(calibration_folder, sgr_folder, bw)
-        mismatch_counts.append(m)
+# Calibration corpus shared with the worker processes, set by init_worker
+shared_corpus = {}
+
+def init_worker(corpus):
+    shared_corpus.update(corpus)
+
+def mismatch_worker(args):
+    # Mismatch counts for a chunk of bandwidths
+    bws, backend = args
+    return corpus_mismatches(shared_corpus, list(bws), backend)
+
+def mismatch_curve(corpus, bws, backend='sklearn', num_workers=1):
+    # Mismatch counts for a list of bandwidths, split into num_workers chunks
+    chunks = [(chunk, backend) for chunk in np.array_split(np.asarray(bws, dtype=float), num_workers) if len(chunk) > 0]
+    if num_workers > 1 and len(chunks) > 1:
+        with mp.Pool(len(chunks), initializer=init_worker, initargs=(corpus,)) as pool:
+            counts = pool.map(mismatch_worker, chunks)
+    else:
+        counts = [corpus_mismatches(corpus, list(chunk), backend) for chunk, _ in chunks]
+    return np.concatenate(counts) if counts else np.empty(0, dtype=int)
+
+def optimize_bandwidth(calibration_folder, sgr_folder, plot=False, backend='sklearn',
+                       bws=None, refine=0, num_workers=1, return_curve=False):
+    # Finds the bandwidth with the fewest mismatches between the bimodality check and the calibration set.
+    # The calibration set and the 'samples.csv' files are loaded only once.
+    # bws:          bandwidths to evaluate first, defaults to 1, 2, ..., 15
+    # refine:       number of grid refinements around the best bandwidth; every refinement evaluates
+    #               bandwidths at a quarter of the previous spacing, up to 3/4 of it to either side
+    # num_workers:  number of worker processes the bandwidths are split across, None for all CPUs
+    # return_curve: also return the evaluated bandwidths and their mismatch counts (sorted by bandwidth)
+    if bws is None:
+        bws = np.arange(1, 16, step=1.0)
+    bws = np.asarray(bws, dtype=float)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    corpus = load_calibration_corpus(calibration_folder, sgr_folder)
+
+    # Evaluated bandwidths and their mismatch counts
+    curve = dict(zip(bws, mismatch_curve(corpus, bws, backend, num_workers)))
+
+    step = np.min(np.diff(np.unique(bws))) if len(np.unique(bws)) > 1 else 1.0
+    for _ in range(refine):
+        best = min(curve, key=lambda b: (curve[b], b))
+        step /= 4
+        candidates = [b for b in best + step * np.arange(-3, 4) if b > 0 and b not in curve]
+        curve.update(zip(candidates, mismatch_curve(corpus, candidates, backend, num_workers)))
+
+    bws = np.array(sorted(curve))
+    mismatch_counts = np.array([curve[b] for b in bws])
 
     if plot:
+        import matplotlib.pyplot as plt
         plt.figure()
         plt.plot(bws, mismatch_counts, color='deeppink')
         plt.xlabel("Bandwidth")
@@ -17,5 +66,27 @@ def optimize_bandwidth(calibration_folder, sgr_folder, plot=False):
     
     
     am = np.argmin(mismatch_counts)
+    if return_curve:
+        return bws[am], bws, mismatch_counts
     return bws[am]
 
+def save_optimal_bandwidth(calibration_folder, bw):
+    # Adds a user-defined bandwidth to optimal_bandwidth.csv in the calibration folder,
+    # or updates its date if it is already there. Returns the path of the file.
+    file_path = os.path.join(calibration_folder, "optimal_bandwidth.csv")
+    d = datetime.today().strftime("%Y-%m-%d")
+    if os.path.exists(file_path):
+        df = pd.read_csv(file_path)
+    else:
+        df = pd.DataFrame(columns=["Date", "Type", "Optimal bandwidth"])
+    if bw not in df["Optimal bandwidth"].values:
+        new_row = pd.DataFrame({
+            "Date": [d],
+            "Type": ["user-defined"],
+            "Optimal bandwidth": [bw]
+        })
+        df = pd.concat([df, new_row], ignore_index=True)
+    else:
+        df.loc[df["Optimal bandwidth"] == bw, "Date"] = d
+    df.to_csv(file_path, index=False)
+    return file_path
@@ -0,0 +1,62 @@
+import numpy as np
+import os
+
+# Points files store one row per sampled point.
+# .npz files hold typed columns: integer coordinates ((-1, -1) for a missing closest point)
+# and float32 slopes and angles (NaN if missing). Legacy .csv files store the coordinates
+# as strings like "[123 456]" and can still be read and written. pandas is only imported for them,
+# so the point sampling workers do not load it.
+POINT_COLUMNS = ['pixel', 'closest contour point', 'closest skeleton point']
+VALUE_COLUMNS = ['slope at nc', 'slope at ns', 'average slope', 'average angle']
+
+def parse_points_column(column):
+    # Parses a column of coordinate strings; empty cells become (-1, -1)
+    points = np.full((len(column), 2), -1, dtype=np.int32)
+    for i, item in enumerate(column):
+        if isinstance(item, str) and item.strip('[]').split():
+            points[i] = [int(num) for num in item.strip('[]').split()]
+    return points
+
+def points_dataframe(points):
+    # Converts a dictionary of point columns into the legacy Points table
+    import pandas as pd
+    def as_list(coords):
+        return [None if c[0] < 0 else c for c in coords]
+
+    return pd.DataFrame({
+        'pixel': list(points['pixel']),
+        'closest contour point': as_list(points['closest contour point']),
+        'closest skeleton point': as_list(points['closest skeleton point']),
+        'slope at nc': points['slope at nc'],
+        'slope at ns': points['slope at ns'],
+        'average slope': points['average slope'],
+        'average angle': points['average angle']
+    })
+
+def write_points(path, points, export_csv=False):
+    # Saves a dictionary of point columns to path (.npz, or .csv for the legacy format).
+    # export_csv: also write the legacy CSV next to a .npz file
+    if path.endswith('.csv'):
+        points_dataframe(points).to_csv(path, index=False)
+        return
+
+    columns = {key: np.asarray(points[key], dtype=np.int32) for key in POINT_COLUMNS}
+    columns.update({key: np.asarray(points[key], dtype=np.float32) for key in VALUE_COLUMNS})
+    with open(path, 'wb') as f:
+        np.savez(f, **columns)
+
+    if export_csv:
+        points_dataframe(points).to_csv(os.path.splitext(path)[0] + '.csv', index=False)
+
+def read_points(path):
+    # Loads a Points file (.npz or legacy .csv) as a dictionary of typed columns
+    if path.endswith('.npz'):
+        with np.load(path) as bundle:
+            return {key: bundle[key] for key in POINT_COLUMNS + VALUE_COLUMNS}
+
+    import pandas as pd
+    data = pd.read_csv(path)
+    points = {key: parse_points_column(data[key]) for key in POINT_COLUMNS}
+    # keep the full precision of the text values
+    points.update({key: data[key].to_numpy(dtype=float) for key in VALUE_COLUMNS})
+    return points
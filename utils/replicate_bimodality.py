@@ -0,0 +1,37 @@
+import os
+import random
+from points_io import read_points
+from replicate_store import draw_cohorts, store_path, write_replicate_store, read_replicate_store, export_replicate_csvs
+from check_bimodality_across_replicates import bimodality_of_store
+
+def replicate_bimodality(args, persist_dir=None, export_csv=False, backend='sklearn', num_workers=1, seed=None):
+    # Draws the replicates of a Points file and applies the bimodality test to them in memory,
+    # without writing the cohorts to disk. Gives the same results as generate_replicates
+    # followed by check_bimodality_across_replicates.
+    # persist_dir: if given, the replicate store is also saved there for auditing
+    # export_csv:  with persist_dir, also write every cohort as a CSV file
+    # backend:     KDE backend, see check_bimodality_across_replicates
+    # num_workers: number of worker processes, see check_bimodality_across_replicates
+    # seed:        seed of the replicates; by default they are drawn from the state of the random module
+    data_path, n_replicates, bw, save_path = args
+
+    points = read_points(data_path)
+    name = os.path.splitext(os.path.basename(data_path))[0]
+
+    cohort_sizes, indices = draw_cohorts(len(points['pixel']), n_replicates,
+                                         random if seed is None else random.Random(seed))
+
+    if persist_dir is not None:
+        os.makedirs(persist_dir, exist_ok=True)
+        path = store_path(persist_dir, name)
+        write_replicate_store(path, name, points, cohort_sizes, indices)
+        if export_csv:
+            with read_replicate_store(path) as store:
+                export_replicate_csvs(store, persist_dir)
+
+    store = {'cohort_sizes': cohort_sizes, 'indices': indices,
+             'pixel': points['pixel'], 'slope': points['average slope'].astype(float),
+             'angle': points['average angle'].astype(float)}
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    bimodality_of_store(name, store, bw, backend, num_workers).to_csv(save_path)
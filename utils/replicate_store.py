@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import os
+import random
+
+# A replicate store keeps all cohorts of all replicates of one river in a single file.
+# Only the sampled row indices are stored, together with the columns of the Points data
+# they refer to (pixel, average slope, average angle), so the store stays valid even if
+# the Points file is regenerated. Cohorts are resolved lazily when they are read.
+STORE_SUFFIX = '_replicates.npz'
+
+COHORT_SIZES = np.array([2, 3, 4, 5, 6, 8, 9, 10, 12, 15, 16, 20, 24, 25, 30, 32,
+                         32, 40, 50, 60, 80, 90, 100, 120, 150, 160, 200,
+                         240, 250, 300, 320,
+                         400, 500, 600, 750, 800, 1000, 1250,
+                         1600, 2000, 2500])
+
+def draw_cohorts(n_points, n_replicates, rng=random):
+    # Draws the rows of one cohort of every size (up to n_points) for each replicate.
+    # Every size is kept once; a repeated size keeps its last cohort
+    # (like the cohort file that used to be overwritten).
+    # rng: random.Random instance to draw from, defaults to the random module itself
+    # Returns the cohort sizes and an array of shape (n_replicates, sum(cohort sizes)).
+    cohort_sizes_trunc = COHORT_SIZES[COHORT_SIZES <= n_points]
+    unique_sizes = np.unique(cohort_sizes_trunc)
+    indices = np.empty((n_replicates, unique_sizes.sum()), dtype=np.int64)
+    offsets = dict(zip(unique_sizes, np.concatenate([[0], np.cumsum(unique_sizes)[:-1]])))
+
+    for r in range(n_replicates):
+        for n in cohort_sizes_trunc:
+            # Choose 'n' random data points for one cohort of size 'n' of this replicate
+            indices[r, offsets[n]:offsets[n] + n] = rng.sample(range(n_points), n)
+    return unique_sizes, indices
+
+def store_path(output_path, name):
+    return os.path.join(output_path, f"{name}{STORE_SUFFIX}")
+
+def find_replicate_store(data_dir):
+    # Returns the path of the replicate store in data_dir, or None if there is none
+    for file_name in sorted(os.listdir(data_dir)):
+        if file_name.endswith(STORE_SUFFIX):
+            return os.path.join(data_dir, file_name)
+    return None
+
+def write_replicate_store(path, name, points, cohort_sizes, indices):
+    # indices: array of shape (n_replicates, sum(cohort_sizes)) holding the sampled rows
+    # of every cohort of a replicate, one cohort after the other
+    n_points = len(points['pixel'])
+    with open(path, 'wb') as f:
+        np.savez_compressed(f,
+                            name=np.array(name),
+                            cohort_sizes=np.asarray(cohort_sizes, dtype=np.int64),
+                            indices=np.asarray(indices, dtype=np.min_scalar_type(max(n_points - 1, 0))),
+                            pixel=points['pixel'],
+                            slope=np.asarray(points['average slope'], dtype=float),
+                            angle=np.asarray(points['average angle'], dtype=float))
+
+def read_replicate_store(path):
+    # Returns the lazily loaded store (an open NpzFile, arrays are read on first access)
+    return np.load(path)
+
+def iter_cohorts(store):
+    # Yields (replicate, cohort size, cohort) for every cohort in the store, replicates numbered from 1.
+    # Each cohort has the layout of the cohort CSV files: pixel row, pixel column, slope, angle.
+    cohort_sizes = store['cohort_sizes']
+    offsets = np.concatenate([[0], np.cumsum(cohort_sizes)])
+    indices = store['indices']
+    pixel, slope, angle = store['pixel'], store['slope'], store['angle']
+
+    for r in range(len(indices)):
+        for j, n in enumerate(cohort_sizes):
+            rows = indices[r, offsets[j]:offsets[j + 1]]
+            cohort = np.column_stack([pixel[rows], slope[rows], angle[rows]]).astype(float)
+            yield r + 1, int(n), cohort
+
+def export_replicate_csvs(store, output_path):
+    # Writes the cohorts of a store as CSV files, one directory per replicate
+    name = str(store['name'])
+    for r, n, cohort in iter_cohorts(store):
+        replicate_dir = os.path.join(output_path, f"replicate_{r}")
+        os.makedirs(replicate_dir, exist_ok=True)
+        cohort_path = os.path.join(replicate_dir, f"{name}_{n}_samples.csv")
+        pd.DataFrame(cohort).to_csv(cohort_path, index=False, header=False)
@@ -1,6 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from math import pi
 
 # we need the angles in radians
 
@@ -0,0 +1,139 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# The packed SGR corpus keeps the angles of all sine-generated rivers and of their cohorts
+# ('<river>_<n>samples.csv') in a single file, so the calibration tools do not have to walk the
+# sgr directory and parse every CSV file on each run. Layout of the file:
+#   - the size of the header in bytes (uint64)
+#   - a JSON header: file name, path (relative to the sgr directory), river, width parameter
+#     and cohort size of every entry (rivers themselves are stored with cohort size 0), and the
+#     path, size and modification time of every CSV file the corpus was packed from
+#   - the offsets of the entries in the angle array (int64, one more than there are entries)
+#   - the average angles of all entries, one after the other (float64)
+# The offsets and angles are memory-mapped when the corpus is read. The corpus is repacked when the
+# CSV files of the sgr directory change (see load_sgr_corpus).
+CORPUS_FILE = 'sgr_corpus.pack'
+
+def corpus_path(sgr_folder):
+    return os.path.join(sgr_folder, CORPUS_FILE)
+
+def river_width(river):
+    # Width parameter encoded in a river name, e.g. 0.5 for 'w0point5_1', NaN if there is none
+    try:
+        return float(river.split('_')[0][1:].replace('point', '.'))
+    except ValueError:
+        return float('nan')
+
+def parse_sgr_file(file_name):
+    # Returns (river, cohort size) of a CSV file of the sgr directory, cohort size 0 for a river,
+    # or None for a file that is neither a river nor one of its cohorts
+    if not file_name.endswith('.csv'):
+        return None
+    stem = file_name[:-len('.csv')]
+    if stem.endswith('samples'):
+        river, _, size = stem[:-len('samples')].rpartition('_')
+        return (river, int(size)) if river and size.isdigit() else None
+    if file_name.startswith('w'):
+        return stem, 0
+    return None
+
+def sgr_files(sgr_folder):
+    # Paths (relative to the sgr directory) of the CSV files of all rivers and cohorts, in packing order
+    paths = []
+    for root, dirs, files in os.walk(sgr_folder):
+        dirs.sort()
+        for file in sorted(files):
+            if parse_sgr_file(file) is not None:
+                paths.append(os.path.relpath(os.path.join(root, file), sgr_folder).replace(os.sep, '/'))
+    return paths
+
+def source_stamp(sgr_folder):
+    # Path, size and modification time of every CSV file of the corpus, to detect a stale corpus
+    stamp = []
+    for path in sgr_files(sgr_folder):
+        stat = os.stat(os.path.join(sgr_folder, path))
+        stamp.append([path, stat.st_size, stat.st_mtime_ns])
+    return stamp
+
+def write_sgr_corpus(path, paths, angles, source=None):
+    # paths:  paths of the entries relative to the sgr directory
+    # angles: one array of average angles per entry
+    # source: source stamp of the CSV files the entries were read from (see source_stamp)
+    files = [os.path.basename(p) for p in paths]
+    parsed = [parse_sgr_file(f) for f in files]
+    header = {
+        'files': files,
+        'paths': [p.replace(os.sep, '/') for p in paths],
+        'rivers': [river for river, _ in parsed],
+        'widths': [river_width(river) for river, _ in parsed],
+        'cohort_sizes': [size for _, size in parsed],
+        'source': source,
+    }
+    header = json.dumps(header).encode()
+    header += b' ' * (-len(header) % 8)
+    offsets = np.concatenate([[0], np.cumsum([len(a) for a in angles])]).astype('<i8')
+
+    # Written to a temporary file first, so readers never see a partially written corpus
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(np.array([len(header)], dtype='<u8').tobytes())
+        f.write(header)
+        f.write(offsets.tobytes())
+        for a in angles:
+            f.write(np.asarray(a, dtype='<f8').tobytes())
+    os.replace(tmp_path, path)
+
+def pack_sgr_corpus(sgr_folder):
+    # Reads the CSV files of all rivers and cohorts of the sgr directory once and packs their angles
+    # into CORPUS_FILE. Returns the path of the packed corpus.
+    source = source_stamp(sgr_folder)
+    paths = [path for path, _, _ in source]
+    angles = [pd.read_csv(os.path.join(sgr_folder, path))['average angle'].values for path in paths]
+
+    path = corpus_path(sgr_folder)
+    write_sgr_corpus(path, paths, angles, source)
+    return path
+
+def read_sgr_corpus(path):
+    # Returns a dictionary with the metadata of all entries (files, paths, river, width, cohort_size)
+    # and their memory-mapped offsets and angles; the angles of entry i are angles[offsets[i]:offsets[i + 1]]
+    with open(path, 'rb') as f:
+        header_size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(header_size))
+
+    n_entries = len(header['files'])
+    start = 8 + header_size
+    offsets = np.memmap(path, dtype='<i8', mode='r', offset=start, shape=(n_entries + 1,))
+    n_angles = int(offsets[-1])
+    if n_angles > 0:
+        angles = np.memmap(path, dtype='<f8', mode='r', offset=start + offsets.nbytes, shape=(n_angles,))
+    else:
+        angles = np.empty(0)
+
+    return {
+        'files': header['files'],
+        'paths': header['paths'],
+        'river': np.array(header['rivers'], dtype=str),
+        'width': np.array(header['widths'], dtype=float),
+        'cohort_size': np.array(header['cohort_sizes'], dtype=int),
+        'offsets': offsets,
+        'angles': angles,
+        'source': header.get('source'),
+    }
+
+def load_sgr_corpus(sgr_folder):
+    # Reads the packed corpus of the sgr directory. It is (re)packed first if it does not exist yet
+    # or if a CSV file was added, removed or changed since it was packed.
+    path = corpus_path(sgr_folder)
+    if os.path.exists(path):
+        corpus = read_sgr_corpus(path)
+        if corpus['source'] == source_stamp(sgr_folder):
+            return corpus
+        del corpus
+    pack_sgr_corpus(sgr_folder)
+    return read_sgr_corpus(path)
+
+def entry_angles(corpus, i):
+    return corpus['angles'][corpus['offsets'][i]:corpus['offsets'][i + 1]]
@@ -0,0 +1,49 @@
+import os
+import sys
+import csv
+import time
+import subprocess
+from datetime import datetime
+
+# Cold-start latency of the GUI, the command-line interface and the modules imported by the pool workers
+# (a worker process imports the module of its task function), each measured in a fresh interpreter.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_TARGETS = {
+    'gui': 'run',
+    'cli': 'cli',
+    'points worker': 'generate_points_multiprocessing',
+    'test worker': 'check_bimodality_across_replicates',
+    'calibration worker': 'optimize_bandwidth',
+    'controls worker': 'build_control_set',
+}
+
+def cold_start(code, repeats):
+    # Best wall time of running the code in a fresh interpreter
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=ROOT)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def measure_startup(repeats=3, output_path=None):
+    # Import time of every target in seconds, less the start-up time of the interpreter itself.
+    # With output_path, the results are appended to a CSV file (date, target, module, seconds)
+    # to track them over time.
+    paths = [ROOT, os.path.join(ROOT, 'utils')]
+    interpreter = cold_start("pass", repeats)
+    results = {}
+    for target, module in STARTUP_TARGETS.items():
+        results[target] = cold_start(f"import sys; sys.path[:0] = {paths!r}; import {module}", repeats) - interpreter
+
+    if output_path is not None:
+        new_file = not os.path.exists(output_path)
+        with open(output_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(['date', 'target', 'module', 'seconds'])
+            date = datetime.now().strftime("%Y-%m-%d %H:%M")
+            for target, seconds in results.items():
+                writer.writerow([date, target, STARTUP_TARGETS[target], f"{seconds:.3f}"])
+    return results
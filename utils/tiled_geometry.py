@@ -0,0 +1,220 @@
+import numpy as np
+import os
+from PIL import Image
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from utils.bank_labels import EIGHT, bank_region, bank_barrier, fill_barrier
+
+# Tiled processing of river rasters that are too large to be held in memory.
+# All rasters are memory-mapped .npy files in a work directory; only one tile
+# (plus its halo) is processed in memory at a time.
+
+def tile_slices(shape, tile):
+    # Core regions (r0, r1, c0, c1) of all tiles, row by row
+    for r0 in range(0, shape[0], tile):
+        for c0 in range(0, shape[1], tile):
+            yield r0, min(r0 + tile, shape[0]), c0, min(c0 + tile, shape[1])
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+def tiff_page(tiff):
+    # First page of a TIFF file if it can be decoded one strip or tile at a time (1-bit or 8-bit grayscale
+    # or RGB(A) pixels, interleaved color samples, no compression or one that tifffile decodes by
+    # itself, e.g. deflate or packbits but not LZW or JPEG), otherwise None
+    from tifffile import TIFF, PHOTOMETRIC, PLANARCONFIG
+    page = tiff.pages[0]
+    if (page.compression in TIFF.DECOMPRESSORS and page.bitspersample in (1, 8)
+            and page.photometric in (PHOTOMETRIC.MINISBLACK, PHOTOMETRIC.MINISWHITE, PHOTOMETRIC.RGB)
+            and (page.samplesperpixel == 1 or page.planarconfig == PLANARCONFIG.CONTIG)):
+        return page
+    return None
+
+def grayscale(values, photometric):
+    # 8-bit grayscale values of decoded TIFF samples (..., samples), with the weights of PIL's 'L' mode
+    from tifffile import PHOTOMETRIC
+    if values.dtype == bool:
+        values = values.astype(np.uint8) * 255
+    if photometric == PHOTOMETRIC.RGB:
+        rgb = values[..., :3].astype(np.uint32)
+        return ((rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+    if photometric == PHOTOMETRIC.MINISWHITE:
+        return 255 - values[..., 0]
+    return values[..., 0]
+
+def binarize_tiff(page, out_path, threshold=128):
+    # Converts a TIFF page (see tiff_page) to a memory-mapped binary raster, one strip or tile at a time
+    rows, cols = page.imagelength, page.imagewidth
+    binary = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8, shape=(rows, cols))
+
+    # Segments are (depth, rows, columns, samples) blocks; tiles at the image edge are padded
+    for segment, index, _ in page.segments():
+        r0, c0 = index[2], index[3]
+        r1, c1 = min(r0 + segment.shape[1], rows), min(c0 + segment.shape[2], cols)
+        binary[r0:r1, c0:c1] = grayscale(segment[0, :r1 - r0, :c1 - c0], page.photometric) >= threshold
+    binary.flush()
+    return binary
+
+def binarize_to_memmap(image_path, out_path, threshold=128, band_rows=1024):
+    # Converts an image to a memory-mapped binary raster (uint8, 0/1).
+    # image_path: a .npy file holding a 2-D grayscale (0-255) raster, which is memory-mapped and
+    #             converted band by band, or a TIFF file, which is decoded one strip or tile at a time
+    #             (see tiff_page). Other images can only be decoded as a whole, so they are limited to
+    #             PIL's Image.MAX_IMAGE_PIXELS pixels.
+    if image_path.lower().endswith(TIFF_EXTENSIONS):
+        from tifffile import TiffFile
+        with TiffFile(image_path) as tiff:
+            page = tiff_page(tiff)
+            if page is not None:
+                return binarize_tiff(page, out_path, threshold)
+
+    if image_path.endswith('.npy'):
+        source = np.load(image_path, mmap_mode='r')
+    else:
+        too_large = (f"{image_path} is too large to be decoded as a whole. For tiled mode, convert it to "
+                     f"a .npy file or an uncompressed or deflate-compressed 8-bit TIFF file.")
+        try:
+            image = Image.open(image_path)
+        except Image.DecompressionBombError as e:
+            raise ValueError(too_large) from e
+        if Image.MAX_IMAGE_PIXELS is not None and image.size[0] * image.size[1] > Image.MAX_IMAGE_PIXELS:
+            raise ValueError(too_large)
+        source = np.asarray(image.convert('L'))
+
+    binary = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8, shape=source.shape)
+    for r0 in range(0, source.shape[0], band_rows):
+        r1 = min(r0 + band_rows, source.shape[0])
+        binary[r0:r1] = np.asarray(source[r0:r1]) >= threshold
+    binary.flush()
+    return binary
+
+def tiled_geometry(binary, work_dir, tile=2048, halo=40, edge=10):
+    # Computes skeleton and contour rasters tile by tile.
+    # Every tile is processed together with a halo of neighboring pixels and only its
+    # core is kept, so the rasters can be stitched without seams. The contour is exact for
+    # any halo >= 2; the halo should be at least the neighbor radius N and half the river width
+    # for the skeleton to match the one of the whole image.
+    # Also writes the flat indices of the river pixels that can be sampled (away from the image edge).
+    # Returns memory-mapped skeleton, contour and candidates arrays.
+    from skimage.morphology import skeletonize
+    from skimage import measure
+    rows, cols = binary.shape
+    skeleton = np.lib.format.open_memmap(os.path.join(work_dir, 'skeleton.npy'), mode='w+',
+                                         dtype=bool, shape=binary.shape)
+    contour = np.lib.format.open_memmap(os.path.join(work_dir, 'contour.npy'), mode='w+',
+                                        dtype=np.uint8, shape=binary.shape)
+
+    def interior(r0, r1, c0, c1):
+        # Part of a tile core that is at least edge pixels away from the image edge
+        return (slice(max(r0, edge), max(min(r1, rows - edge), edge)),
+                slice(max(c0, edge), max(min(c1, cols - edge), edge)))
+
+    # Count the candidates first, so that they can be written to a memory-mapped array
+    n_candidates = sum(int(np.count_nonzero(binary[interior(*t)])) for t in tile_slices(binary.shape, tile))
+    candidates = np.lib.format.open_memmap(os.path.join(work_dir, 'candidates.npy'), mode='w+',
+                                           dtype=np.int64, shape=(n_candidates,))
+    n_written = 0
+
+    for r0, r1, c0, c1 in tile_slices(binary.shape, tile):
+        p0, p1 = max(r0 - halo, 0), min(r1 + halo, rows)
+        q0, q1 = max(c0 - halo, 0), min(c1 + halo, cols)
+        window = np.asarray(binary[p0:p1, q0:q1])
+        core = (slice(r0 - p0, r1 - p0), slice(c0 - q0, c1 - q0))
+
+        if not window.any():
+            continue
+
+        # Find river skeleton
+        skeleton[r0:r1, c0:c1] = skeletonize(window, method='lee')[core] > 0
+
+        # Find river contours, keep the points in the core
+        contour_list = measure.find_contours(1 - window, 0)
+        if contour_list:
+            contour_list = np.vstack(contour_list).astype(int)
+            in_core = ((contour_list[:, 0] >= r0 - p0) & (contour_list[:, 0] < r1 - p0) &
+                       (contour_list[:, 1] >= c0 - q0) & (contour_list[:, 1] < c1 - q0))
+            contour_list = contour_list[in_core]
+            contour[contour_list[:, 0] + p0, contour_list[:, 1] + q0] = 1
+
+        # River pixels that can be sampled
+        inner = interior(r0, r1, c0, c1)
+        river = np.argwhere(np.asarray(binary[inner]) > 0) + [inner[0].start, inner[1].start]
+        candidates[n_written:n_written + len(river)] = river[:, 0] * cols + river[:, 1]
+        n_written += len(river)
+
+    skeleton.flush()
+    contour.flush()
+    candidates.flush()
+    return skeleton, contour, candidates
+
+def label_banks_tiled(binary, skeleton, out_path, tile=2048, halo=40, margin=2):
+    # Tiled version of label_banks: labels each tile separately, then merges the labels
+    # of regions that touch across tile borders (8-connectivity).
+    # The barrier of every tile is computed with a halo of neighboring pixels, which should be at
+    # least the length of the tip extensions (about 1.5 river widths, see bank_barrier).
+    rows, cols = binary.shape
+    labels = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.int32, shape=binary.shape)
+
+    # Barrier pixels that are not on the skeleton are marked with -1 and filled in at the end
+    n_labels = 0
+    for r0, r1, c0, c1 in tile_slices(binary.shape, tile):
+        p0, p1 = max(r0 - halo, 0), min(r1 + halo, rows)
+        q0, q1 = max(c0 - halo, 0), min(c1 + halo, cols)
+        core = (slice(r0 - p0, r1 - p0), slice(c0 - q0, c1 - q0))
+        window_skeleton = np.asarray(skeleton[p0:p1, q0:q1])
+        region = bank_region(np.asarray(binary[p0:p1, q0:q1]), margin)
+        barrier = bank_barrier(region, window_skeleton)
+
+        local, n = ndimage.label((region & ~barrier)[core], structure=EIGHT)
+        local[local > 0] += n_labels
+        local[(region & barrier & (window_skeleton == 0))[core]] = -1
+        labels[r0:r1, c0:c1] = local
+        n_labels += n
+
+    # Pairs of labels that touch across tile borders, also diagonally
+    pairs = []
+    for r in range(tile, rows, tile):
+        above, below = labels[r - 1], labels[r]
+        pairs.append(np.column_stack([above, below]))
+        pairs.append(np.column_stack([above[:-1], below[1:]]))
+        pairs.append(np.column_stack([above[1:], below[:-1]]))
+    for c in range(tile, cols, tile):
+        left, right = labels[:, c - 1], labels[:, c]
+        pairs.append(np.column_stack([left, right]))
+        pairs.append(np.column_stack([left[:-1], right[1:]]))
+        pairs.append(np.column_stack([left[1:], right[:-1]]))
+    pairs = np.vstack(pairs) if pairs else np.empty((0, 2), dtype=np.int32)
+    pairs = np.unique(pairs[(pairs[:, 0] > 0) & (pairs[:, 1] > 0)], axis=0)
+
+    # Merge touching regions
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n_labels + 1, n_labels + 1))
+    _, component = connected_components(graph, directed=False)
+    lookup = (component + 1).astype(np.int32)
+    lookup[0] = 0
+
+    for r0, r1, c0, c1 in tile_slices(binary.shape, tile):
+        local = labels[r0:r1, c0:c1]
+        labels[r0:r1, c0:c1] = np.where(local > 0, lookup[np.maximum(local, 0)], local)
+
+    # Fill in the marked barrier pixels from their neighbors and clear the pixels outside the river
+    for r0, r1, c0, c1 in tile_slices(binary.shape, tile):
+        p0, p1 = max(r0 - margin - 2, 0), min(r1 + margin + 2, rows)
+        q0, q1 = max(c0 - margin - 2, 0), min(c1 + margin + 2, cols)
+        core = (slice(r0 - p0, r1 - p0), slice(c0 - q0, c1 - q0))
+        window = np.array(labels[p0:p1, q0:q1])
+        window = fill_barrier(window, window < 0)[core]
+        window[(window < 0) | (np.asarray(binary[r0:r1, c0:c1]) == 0)] = 0
+        labels[r0:r1, c0:c1] = window
+
+    labels.flush()
+    return labels
+
+def build_tiled_geometry(image_path, work_dir, tile=2048, halo=40, threshold=128):
+    # Writes binary, skeleton, contour, bank labels and sampling candidates of an image
+    # to memory-mapped .npy files in work_dir and returns their paths.
+    # halo: overlap between tiles, at least the neighbor radius N used for sampling
+    binary = binarize_to_memmap(image_path, os.path.join(work_dir, 'binary.npy'), threshold)
+    skeleton, contour, candidates = tiled_geometry(binary, work_dir, tile, halo)
+    label_banks_tiled(binary, skeleton, os.path.join(work_dir, 'labels.npy'), tile, halo)
+    return {key: os.path.join(work_dir, f"{key}.npy")
+            for key in ['binary', 'skeleton', 'contour', 'labels', 'candidates']}
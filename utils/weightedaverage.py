@@ -49,3 +49,35 @@ def weightedaverage(pix, p1, p2, slope1, slope2):
     else:
         tot = (w1 * slope1 + w2 * slope2) / (w1 + w2)
         return tot
+
+def weightedaverage_batch(pix, p1, p2, slope1, slope2):
+    # Array version of weightedaverage, for arrays of points of shape (K, 2) and K slopes.
+    # The cases are checked in the same order as in weightedaverage.
+    pix, p1, p2 = np.asarray(pix, dtype=float), np.asarray(p1, dtype=float), np.asarray(p2, dtype=float)
+    slope1, slope2 = np.asarray(slope1, dtype=float), np.asarray(slope2, dtype=float)
+
+    dist1 = np.sqrt((p1[:, 0] - pix[:, 0])**2 + (p1[:, 1] - pix[:, 1])**2)
+    dist2 = np.sqrt((p2[:, 0] - pix[:, 0])**2 + (p2[:, 1] - pix[:, 1])**2)
+
+    finite1, finite2 = np.isfinite(slope1), np.isfinite(slope2)
+    opposite = (slope1 == -slope2) & (dist1 == dist2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w1 = 1/dist1
+        w2 = 1/dist2
+        # finite slope on one side only: average the perpendicular slopes instead
+        tot_inf1 = (w2 * (-1/slope2)) / (w1 + w2)
+        tot_inf2 = (w1 * (-1/slope1)) / (w1 + w2)
+        tot = (w1 * slope1 + w2 * slope2) / (w1 + w2)
+
+        return np.select(
+            [~finite1 & ~finite2,
+             (np.abs(slope1) == 0.0) & (np.abs(slope2) == 0.0),
+             opposite & (np.abs(slope1) > 1),
+             opposite & (np.abs(slope1) < 1),
+             (slope1 == 0.0) & ~finite2,
+             ~finite1 & (slope2 == 0.0),
+             ~finite1 & finite2,
+             finite1 & ~finite2],
+            [100.0, 0.0, 100.0, 0.0, -1.0, -1.0, -1/tot_inf1, -1/tot_inf2],
+            default=tot)